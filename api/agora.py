@@ -15,23 +15,206 @@
 import collections
 import datetime
 from distutils.command.config import config
+import glob
 import json
-import jsons
+import os
 import re
 import time
+import yaml
 from urllib.parse import parse_qs
 from flask import (Blueprint, Response, current_app, jsonify, redirect,
                    render_template, request, url_for, g, send_file)
+# state.py lives in the root of this repository, next to pull.py.
+from state import SyncState, health
+from . import webhooks
 
 bp = Blueprint('agora', __name__)
 
+# for /sources.json, when not asked for a page size.
+PER_PAGE = 100
+MAX_PER_PAGE = 1000
+# sync state fields served with each source.
+SOURCE_STATE = ['last_fetch', 'last_success', 'last_change', 'sha', 'size', 'errors', 'consecutive_errors', 'last_error']
+
+# path -> (mtime, parsed sources yaml, {normalized url: [targets]}), so we only parse it again when it changes.
+SOURCES_CACHE = {}
+
+def get_state():
+    if 'state' not in g:
+        g.state = SyncState(current_app.config['STATE'])
+    return g.state
+
+@bp.teardown_app_request
+def close_state(e=None):
+    state = g.pop('state', None)
+    if state:
+        state.close()
+
+def get_sources():
+    path = current_app.config['SOURCES']
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        current_app.logger.warning(f'Sources config {path} not found.')
+        return []
+    cached = SOURCES_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as f:
+            config = yaml.safe_load(f) or []
+        if not isinstance(config, list):
+            raise ValueError(f'expected a list of sources, not {type(config).__name__}')
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        # e.g. caught halfway through being written (PUT /repo appends to it); keep serving what we had.
+        current_app.logger.error(f"Couldn't load sources from {path}: {e}")
+        if not cached:
+            return []
+        # no need to try again until it changes.
+        SOURCES_CACHE[path] = (mtime, cached[1], cached[2])
+        return cached[1]
+    sources = valid_sources(config)
+    targets = {}
+    for source in sources:
+        targets.setdefault(webhooks.normalize(source['url']), []).append(source['target'])
+    SOURCES_CACHE[path] = (mtime, sources, targets)
+    return sources
+
+def valid_sources(config):
+    """Returns the sources in config pull.py would sync (see valid_sources() there), skipping the rest."""
+    sources = []
+    for i, source in enumerate(config):
+        if not isinstance(source, dict) or not all(
+                isinstance(source.get(key), str) and source[key].strip() for key in ('target', 'url', 'format')):
+            current_app.logger.warning(f'Skipping source #{i} in the config: missing or bad target, url or format.')
+            continue
+        sources.append(source)
+    return sources
+
+def get_targets(url):
+    """Returns the targets of the sources that pull from url, however it's spelled."""
+    if not get_sources():
+        return []
+    return SOURCES_CACHE[current_app.config['SOURCES']][2].get(webhooks.normalize(url), [])
+
+def get_bots():
+    """Returns the latest counters dumped by each bot, see bots/metrics.py."""
+    bots = []
+    for path in sorted(glob.glob(os.path.join(current_app.config['METRICS_DIR'], '*.json'))):
+        try:
+            with open(path) as f:
+                bots.append(json.load(f))
+        except (OSError, ValueError):
+            # a bot might be replacing the file right now; we'll get it next time.
+            continue
+    return bots
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+class MetricsWriter(object):
+    """Writes the prometheus text exposition format, see https://prometheus.io/docs/instrumenting/exposition_formats/."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        """samples is a list of (labels dict, value)."""
+        self.lines.append(f'# HELP {name} {help}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            self.lines.append(f'{name}{metric_labels(labels)} {value}')
+
+    def histogram(self, name, help, histogram):
+        self.lines.append(f'# HELP {name} {help}')
+        self.lines.append(f'# TYPE {name} histogram')
+        for le, count in histogram['buckets']:
+            self.lines.append(f'{name}_bucket{metric_labels({"le": le})} {count}')
+        self.lines.append(f'{name}_bucket{metric_labels({"le": "+Inf"})} {histogram["count"]}')
+        self.lines.append(f'{name}_sum {histogram["sum"]}')
+        self.lines.append(f'{name}_count {histogram["count"]}')
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+@bp.route('/metrics')
+def metrics():
+    """Sync and bot metrics for prometheus (or anything that scrapes its text format)."""
+    now = time.time()
+    state = get_state()
+    gardens = state.all()
+    pull = state.get_metrics('pull')
+    out = MetricsWriter()
+
+    if pull:
+        out.metric('agora_bridge_pull_last_update_timestamp_seconds', 'gauge',
+                'When pull.py last reported its metrics; if this stops moving, pull.py is stuck or down.',
+                [({}, pull['updated'])])
+        out.metric('agora_bridge_sync_queue_depth', 'gauge', 'Gardens due for a sync and waiting for a free slot.',
+                [({}, pull['waiting'])])
+        out.metric('agora_bridge_sync_requests_pending', 'gauge', 'Requested syncs waiting for the garden to be free.',
+                [({}, pull.get('requested', 0))])
+        out.metric('agora_bridge_sync_requests_total', 'counter', 'Syncs requested through the api since pull.py started.',
+                [({}, pull['counters'].get('requested', 0))])
+        out.metric('agora_bridge_syncs_in_flight', 'gauge', 'Syncs running right now, by host.',
+                [({'host': host}, count) for host, count in
+                    collections.Counter(sync['host'] for sync in pull['active']).items()])
+        out.metric('agora_bridge_oldest_sync_age_seconds', 'gauge', 'How long the oldest running sync has been running.',
+                [({}, max([pull['updated'] - sync['started'] for sync in pull['active']], default=0))])
+        out.histogram('agora_bridge_sync_duration_seconds', 'How long syncs took.', pull['durations'])
+        out.metric('agora_bridge_syncs_total', 'counter', 'Syncs run since pull.py started.',
+                [({}, pull['counters']['syncs'])])
+        out.metric('agora_bridge_sync_failures_total', 'counter', 'Failed syncs since pull.py started.',
+                [({}, pull['counters']['failed'])])
+
+    out.metric('agora_bridge_gardens', 'gauge', 'Gardens by health.',
+            [({'health': name}, count) for name, count in
+                sorted(collections.Counter(health(garden, now) for garden in gardens).items())])
+    out.metric('agora_bridge_garden_errors_total', 'counter', 'Failed syncs per garden.',
+            [({'garden': garden['target']}, garden['errors']) for garden in gardens])
+    out.metric('agora_bridge_garden_consecutive_errors', 'gauge', 'Failed syncs per garden since the last success.',
+            [({'garden': garden['target']}, garden['consecutive_errors']) for garden in gardens])
+    out.metric('agora_bridge_garden_fetched_bytes_total', 'counter', 'Bytes fetched per garden.',
+            [({'garden': garden['target']}, garden['bytes']) for garden in gardens])
+    out.metric('agora_bridge_garden_last_success_timestamp_seconds', 'gauge', 'When each garden last synced successfully.',
+            [({'garden': garden['target']}, garden['last_success']) for garden in gardens if garden['last_success']])
+
+    bots = get_bots()
+    out.metric('agora_bridge_bot_events_total', 'counter', 'Events seen/handled by each bot, by kind.',
+            [({'bot': bot['bot'], 'kind': name}, value) for bot in bots for name, value in sorted(bot['counters'].items())])
+    out.metric('agora_bridge_bot_event_rate', 'gauge', 'Events per minute by each bot, by kind, over its last reporting interval.',
+            [({'bot': bot['bot'], 'kind': name}, value) for bot in bots for name, value in sorted(bot['rates'].items())])
+    out.metric('agora_bridge_bot_gauge', 'gauge', 'Other numbers reported by each bot, e.g. followers or when it last saw an event.',
+            [({'bot': bot['bot'], 'name': name}, value) for bot in bots for name, value in sorted(bot['gauges'].items())])
+    out.metric('agora_bridge_bot_last_update_timestamp_seconds', 'gauge', 'When each bot last reported its metrics.',
+            [({'bot': bot['bot']}, bot['updated']) for bot in bots])
+    return Response(out.text(), mimetype='text/plain; version=0.0.4')
+
 # The [[agora]] is a [[distributed knowledge graph]].
 # See https://anagora.org, https://anagora.org/go/agora for a description.
 @bp.route('/status')
 def status():
+    now = time.time()
+    gardens = get_state().all()
+    for garden in gardens:
+        garden['health'] = health(garden, now)
+    counts = collections.Counter(garden['health'] for garden in gardens)
+    pull = get_state().get_metrics('pull')
+    if pull:
+        pull['active'].sort(key=lambda sync: sync['started'])
     return render_template(
             'status.html', 
             config=current_app.config,
+            gardens=gardens,
+            counts=counts,
+            pull=pull,
+            bots=get_bots(),
+            now=now,
             )
 
 @bp.route('/')
@@ -40,7 +223,89 @@ def index():
 
 @bp.route('/sources.json')
 def sources():
-    """Returns all sources (repositories) known to this Agora Bridge."""
-    sources = ['placeholder']
-    return jsonify(jsons.dump(sources))
+    """Returns all sources (repositories) known to this Agora Bridge, with their sync state.
+
+    Takes page and per_page for pagination, and format, health and q (a substring of target or url) as filters.
+    Responses carry an ETag; send it back in If-None-Match to get a 304 if nothing changed.
+    """
+    now = time.time()
+    gardens = {garden['target']: garden for garden in get_state().all()}
+    fmt = request.args.get('format')
+    wanted = request.args.get('health')
+    q = request.args.get('q')
+
+    sources = []
+    for source in get_sources():
+        if fmt and source.get('format') != fmt:
+            continue
+        if q and q not in source.get('target', '') and q not in source.get('url', ''):
+            continue
+        garden = gardens.get(source.get('target'))
+        source = dict(source, health=health(garden, now))
+        if wanted and source['health'] != wanted:
+            continue
+        for field in SOURCE_STATE:
+            source[field] = garden[field] if garden else None
+        sources.append(source)
+
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(MAX_PER_PAGE, max(1, request.args.get('per_page', PER_PAGE, type=int)))
+    start = (page - 1) * per_page
+    response = jsonify({
+        'total': len(sources),
+        'page': page,
+        'per_page': per_page,
+        'sources': sources[start:start + per_page],
+        })
+    if start + per_page < len(sources):
+        args = dict(request.args, page=page + 1, per_page=per_page)
+        response.headers['Link'] = f'<{url_for(".sources", _external=True, **args)}>; rel="next"'
+    # clients poll this; make them revalidate every time, which is cheap for everyone when nothing changed.
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@bp.route('/sources/<path:target>/pull', methods=['POST'])
+def pull(target):
+    """Asks pull.py to sync a source right away, instead of when it's next due."""
+    if target not in [source.get('target') for source in get_sources()]:
+        return jsonify({'error': f'unknown source {target}.'}), 404
+    queued = get_state().request(target, origin=f'api ({request.remote_addr})')
+    # 202: pull.py picks requests up within a second or so.
+    return jsonify({'target': target, 'queued': queued}), 202
+
+@bp.route('/webhook', methods=['POST'])
+def webhook():
+    """Takes push webhooks from GitHub, GitLab, Gitea or Forgejo and asks pull.py to sync the repository right away.
+
+    See webhooks.py, and api/README.md for how to try this out.
+    """
+    forge, event = webhooks.detect(request.headers)
+    if not forge:
+        return jsonify({'error': "doesn't look like a webhook from a forge we know."}), 400
+    secret = current_app.config['WEBHOOK_SECRET']
+    if secret and not webhooks.verify(forge, request.headers, request.get_data(), secret):
+        current_app.logger.warning(f'Rejected {forge} webhook from {request.remote_addr}: bad signature.')
+        return jsonify({'error': 'bad signature.'}), 403
+    # anyone can ask for a sync (see /sources/<target>/pull), but only webhooks we can trust get to make pull.py poll
+    # a garden less.
+    trusted = bool(secret)
+    if not webhooks.is_push(forge, event):
+        # e.g. the ping GitHub sends when a webhook is set up.
+        return jsonify({'forge': forge, 'event': event, 'ignored': True})
 
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'expected a JSON payload.'}), 400
+    urls = webhooks.repo_urls(forge, payload)
+    targets = sorted({target for url in urls for target in get_targets(url)})
+    if not targets:
+        return jsonify({'error': f'no source pulls from {urls}.'}), 404
+    state = get_state()
+    for target in targets:
+        if trusted:
+            state.request(target, origin=f'webhook ({forge})')
+            state.record_webhook(target)
+        else:
+            state.request(target, origin=f'unsigned webhook ({forge}, {request.remote_addr})')
+    return jsonify({'forge': forge, 'event': event, 'targets': targets}), 202
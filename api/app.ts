@@ -27,6 +27,14 @@ app.put('/node', async (req,res) => {
 app.put('/repo', async (req,res) => {
     config = await loadFile("config.json")
     const yaml = config.repoYaml
+    // pull.py skips sources missing any of these; newlines would let a request write arbitrary yaml.
+    for (const key of ['target', 'url', 'format']) {
+        const value = req.body[key]
+        if (typeof value != 'string' || !value.trim() || /[\r\n]/.test(value)) {
+            res.status(400).send({status: "error", error: `missing or bad ${key}`})
+            return
+        }
+    }
     fs.appendFileSync(yaml, `\n- target: ${req.body.target}\n  url: ${req.body.url}\n  format: ${req.body.format}`);
     res.send({status: "saved"})
 
@@ -0,0 +1,32 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+class Config(object):
+    # the sync state database written by pull.py (see --state there).
+    STATE = os.environ.get('AGORA_BRIDGE_STATE', os.path.join(os.getcwd(), 'state.db'))
+    # the sources config pull.py reads (see --config there).
+    SOURCES = os.environ.get('AGORA_BRIDGE_SOURCES', os.path.expanduser('~/agora/sources.yaml'))
+    # shared secret for /webhook; when set, webhooks need to be signed with it (or carry it, for GitLab). Without it
+    # webhooks only ask for a sync, see webhook() in agora.py.
+    WEBHOOK_SECRET = os.environ.get('AGORA_BRIDGE_WEBHOOK_SECRET')
+    # where bots dump their event counters (see --metrics in the bots).
+    METRICS_DIR = os.environ.get('AGORA_BRIDGE_METRICS', os.path.join(os.getcwd(), 'metrics'))
+
+class DevelopmentConfig(Config):
+    pass
+
+class ProductionConfig(Config):
+    pass
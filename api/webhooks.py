@@ -0,0 +1,85 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# push webhooks from forges (GitHub, GitLab, Gitea, Forgejo): which forge sent it, whether it's genuine, and which
+# repository it's about. See /webhook in agora.py, and fixtures/ for example payloads.
+
+import hashlib
+import hmac
+import re
+import urllib.parse
+
+# forge -> (header naming the event, events that mean new commits).
+# Forgejo also sends the Gitea headers, so it has to be checked first.
+EVENTS = {
+    'forgejo': ('X-Forgejo-Event', ['push']),
+    'gitea': ('X-Gitea-Event', ['push']),
+    'gitlab': ('X-Gitlab-Event', ['Push Hook', 'Tag Push Hook']),
+    'github': ('X-GitHub-Event', ['push']),
+}
+
+# git@github.com:flancian/garden.git
+SCP_RE = re.compile(r'^(?:[^@/]+@)?([^:/]+):(.*)$')
+
+def detect(headers):
+    """Returns (forge, event) for a webhook request, or (None, None) if it doesn't look like one we know."""
+    for forge, (header, _) in EVENTS.items():
+        if header in headers:
+            return forge, headers[header]
+    return None, None
+
+def is_push(forge, event):
+    return event in EVENTS[forge][1]
+
+def verify(forge, headers, body, secret):
+    """Checks that a webhook was sent by someone who knows secret."""
+    if forge == 'gitlab':
+        # GitLab sends the secret itself instead of signing the payload.
+        return hmac.compare_digest(headers.get('X-Gitlab-Token', ''), secret)
+    if forge == 'github':
+        signature = headers.get('X-Hub-Signature-256', '')
+        if not signature.startswith('sha256='):
+            return False
+        signature = signature[len('sha256='):]
+    else:
+        signature = headers.get('X-Forgejo-Signature') or headers.get('X-Gitea-Signature', '')
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+def repo_urls(forge, payload):
+    """Returns all the urls a push payload gives for its repository (web, https, ssh...)."""
+    if forge == 'gitlab':
+        repo = payload.get('project') or payload.get('repository') or {}
+        keys = ['git_http_url', 'git_ssh_url', 'web_url', 'url', 'homepage']
+    else:
+        repo = payload.get('repository') or {}
+        keys = ['clone_url', 'html_url', 'ssh_url', 'git_url', 'url']
+    return [repo[key] for key in keys if isinstance(repo.get(key), str)]
+
+def normalize(url):
+    """Reduces a repository url to host/path, so https, ssh and web urls for the same repository compare equal."""
+    url = url.strip()
+    if '://' in url:
+        parts = urllib.parse.urlsplit(url)
+        host, path = (parts.hostname or ''), parts.path
+    else:
+        match = SCP_RE.match(url)
+        if not match:
+            return url.lower()
+        host, path = match.groups()
+    path = path.strip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    # forges treat owner and repository names case insensitively.
+    return f'{host.lower()}/{path.lower()}'
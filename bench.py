@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# a benchmark for pull.py: sets up a fake forge with N local bare repos, keeps committing to some of them while
+# pull.py runs against them, and reports how well pull.py kept up.
+#
+# example, comparing two sets of scheduling flags:
+#
+#   ./bench.py --repos 500 --duration 300 --pull-args='--min-interval 10 --max-interval 120'
+#   ./bench.py --repos 500 --duration 300 --pull-args='--min-interval 10 --max-interval 120 --transport multiplex'
+#
+# reported numbers:
+# - syncs/s: how many gardens pull.py got through per second.
+# - sync duration: how long each sync took (as recorded by pull.py in its state database).
+# - propagation: time from a commit landing in the fake forge to pull.py having it, which is what users notice.
+# - cpu: user + system time of pull.py and everything it ran.
+# - git forks: how many git processes pull.py started.
+
+import argparse
+import os
+import random
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from state import SyncState
+
+this_path = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark for the Agora Bridge pull pipeline.')
+parser.add_argument('--repos', dest='repos', type=int, default=100, help='How many repos to serve from the fake forge.')
+parser.add_argument('--sizes', dest='sizes', default='10,100,1000', help='Comma separated number of files per repo; repos cycle through these.')
+parser.add_argument('--file-size', dest='file_size', type=int, default=1024, help='Size of each file, in bytes.')
+parser.add_argument('--change-rate', dest='change_rate', type=float, default=0.05, help='Fraction of repos that get a new commit every round.')
+parser.add_argument('--round', dest='round', type=float, default=10, help='Time between rounds of commits, in seconds.')
+parser.add_argument('--duration', dest='duration', type=float, default=120, help='How long to run pull.py for, in seconds.')
+parser.add_argument('--forge', dest='forge', choices=['file', 'daemon'], default='file', help='Serve repos as file:// urls or through a local git daemon (git://).')
+parser.add_argument('--pull-args', dest='pull_args', default='', help='Extra arguments for pull.py, e.g. scheduling flags to compare.')
+parser.add_argument('--workdir', dest='workdir', help='Where to put the fake forge and clones; a temporary directory by default, removed afterwards.')
+parser.add_argument('--seed', dest='seed', type=int, default=0, help='Random seed, so runs are comparable.')
+args = parser.parse_args()
+
+GIT = shutil.which('git')
+DAEMON_PORT = 9419
+
+def git(*argv, **kwargs):
+    return subprocess.run([GIT, *argv], check=True, capture_output=True, **kwargs)
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def make_forge(forge_dir, n, sizes, file_size):
+    """Creates n bare repos in forge_dir, returns their names."""
+    # one seed repo per size, every bare repo is cloned from one of those.
+    seeds = {}
+    for size in sizes:
+        seed = os.path.join(forge_dir, f'seed-{size}')
+        git('init', '-q', seed)
+        for i in range(size):
+            with open(os.path.join(seed, f'note {i}.md'), 'w') as f:
+                f.write(f'- [[note {i}]]\n' + 'x' * file_size + '\n')
+        git('add', '.', cwd=seed)
+        git('-c', 'user.name=bench', '-c', 'user.email=bench@example.org', 'commit', '-q', '-m', 'seed', cwd=seed)
+        seeds[size] = seed
+
+    names = []
+    for i in range(n):
+        name = f'garden-{i}.git'
+        git('clone', '-q', '--bare', seeds[sizes[i % len(sizes)]], os.path.join(forge_dir, name))
+        names.append(name)
+    for seed in seeds.values():
+        shutil.rmtree(seed)
+    return names
+
+def commit(repo, n):
+    """Adds a commit to a bare repo without a working tree, returns the new sha."""
+    # fast-import can't resolve HEAD itself.
+    head = git('symbolic-ref', 'HEAD', cwd=repo).stdout.decode().strip()
+    data = f'- change {n} at {time.time()}\n'
+    script = (
+        f'commit {head}\n'
+        'committer bench <bench@example.org> now\n'
+        'data 5\nbench\n'
+        f'from {head}^0\n'
+        f'M 100644 inline changes.md\ndata {len(data)}\n{data}\n'
+        )
+    git('fast-import', '--quiet', '--date-format=now', cwd=repo, input=script.encode())
+    return git('rev-parse', head, cwd=repo).stdout.decode().strip()
+
+def make_git_shim(shim_dir, log):
+    """Puts a git in front of the real one in PATH that counts invocations."""
+    shim = os.path.join(shim_dir, 'git')
+    with open(shim, 'w') as f:
+        f.write(f'#!/bin/sh\necho >> {log}\nexec {GIT} "$@"\n')
+    os.chmod(shim, os.stat(shim).st_mode | stat.S_IEXEC)
+
+def cpu_seconds(pid):
+    """utime + stime of pid and its waited-for children, from /proc (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except FileNotFoundError:
+        return float('nan')
+    # utime, stime, cutime, cstime are fields 14-17 in proc(5), i.e. 11-14 after the command name.
+    return sum(int(x) for x in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+
+def main():
+    random.seed(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='agora-bench-')
+    forge_dir = os.path.join(workdir, 'forge')
+    output_dir = os.path.join(workdir, 'agora')
+    shim_dir = os.path.join(workdir, 'bin')
+    for d in (forge_dir, output_dir, shim_dir):
+        os.makedirs(d, exist_ok=True)
+
+    print(f'Setting up {args.repos} repos in {forge_dir}...')
+    names = make_forge(forge_dir, args.repos, sizes, args.file_size)
+
+    daemon = None
+    if args.forge == 'daemon':
+        daemon = subprocess.Popen([GIT, 'daemon', '--reuseaddr', '--export-all', f'--base-path={forge_dir}',
+            '--listen=127.0.0.1', f'--port={DAEMON_PORT}', forge_dir])
+        base_url = f'git://127.0.0.1:{DAEMON_PORT}'
+    else:
+        base_url = f'file://{forge_dir}'
+
+    sources = [{'target': f'garden/{name[:-len(".git")]}', 'url': f'{base_url}/{name}', 'format': 'foam'} for name in names]
+    config = os.path.join(workdir, 'sources.yaml')
+    with open(config, 'w') as f:
+        yaml.dump(sources, f)
+
+    fork_log = os.path.join(workdir, 'forks.log')
+    open(fork_log, 'w').close()
+    make_git_shim(shim_dir, fork_log)
+    env = dict(os.environ, PATH=shim_dir + os.pathsep + os.environ['PATH'])
+    state_path = os.path.join(workdir, 'state.db')
+
+    cmd = [sys.executable, os.path.join(this_path, 'pull.py'), '--config', config, '--output-dir', output_dir,
+            '--state', state_path, '--changelog', os.path.join(workdir, 'changes.jsonl'), *args.pull_args.split()]
+    print(f'Running {" ".join(cmd)} for {args.duration}s...')
+    # pull.py logs to stderr; a file rather than a pipe, so a long run can't fill it up and block pull.py.
+    log_path = os.path.join(workdir, 'pull.log')
+    with open(log_path, 'w') as log:
+        pull = subprocess.Popen(cmd, cwd=this_path, env=env, stdout=subprocess.DEVNULL, stderr=log)
+    # pull.py creates this on startup.
+    while not os.path.exists(state_path):
+        if pull.poll() is not None:
+            if daemon:
+                daemon.terminate()
+            with open(log_path) as f:
+                sys.stderr.write(f.read())
+            print(f'pull.py exited with {pull.returncode} during startup (workdir: {workdir}).', file=sys.stderr)
+            sys.exit(pull.returncode or 1)
+        time.sleep(0.1)
+    state = SyncState(state_path)
+
+    started = time.time()
+    next_round = started + args.round
+    # (target, last_fetch) -> duration, one entry per sync.
+    syncs = {}
+    # target -> [(sha, committed at)] we are waiting to see in the clone.
+    pending = {}
+    propagation = []
+    commits = 0
+    while time.time() - started < args.duration:
+        now = time.time()
+        if now >= next_round:
+            for name in random.sample(names, max(1, int(len(names) * args.change_rate))):
+                target = f'garden/{name[:-len(".git")]}'
+                sha = commit(os.path.join(forge_dir, name), commits)
+                pending.setdefault(target, []).append((sha, time.time()))
+                commits += 1
+            next_round += args.round
+
+        for garden in state.all():
+            if garden['last_fetch']:
+                syncs[(garden['target'], garden['last_fetch'])] = garden['duration']
+            waiting = pending.get(garden['target'])
+            if waiting and garden['sha'] in [sha for sha, _ in waiting]:
+                # the clone has this commit and everything committed before it.
+                while waiting:
+                    sha, committed = waiting.pop(0)
+                    propagation.append(garden['last_fetch'] + garden['duration'] - committed)
+                    if sha == garden['sha']:
+                        break
+        time.sleep(0.25)
+
+    cpu = cpu_seconds(pull.pid)
+    pull.send_signal(signal.SIGTERM)
+    pull.wait()
+    elapsed = time.time() - started
+    if daemon:
+        daemon.terminate()
+        daemon.wait()
+    with open(fork_log) as f:
+        forks = sum(1 for _ in f)
+
+    durations = list(syncs.values())
+    missed = sum(len(waiting) for waiting in pending.values())
+    print()
+    print(f'repos:              {args.repos} ({args.forge}, sizes {args.sizes} files)')
+    print(f'elapsed:            {elapsed:.1f}s')
+    print(f'syncs:              {len(durations)} ({len(durations) / elapsed:.2f} syncs/s)')
+    print(f'sync duration:      p50 {percentile(durations, 50):.3f}s, p99 {percentile(durations, 99):.3f}s')
+    print(f'commits:            {commits}, {missed} not pulled by the end')
+    print(f'propagation:        p50 {percentile(propagation, 50):.1f}s, p99 {percentile(propagation, 99):.1f}s')
+    print(f'cpu:                {cpu:.1f}s ({cpu / elapsed * 100:.0f}% of one core)')
+    print(f'git forks:          {forks} ({forks / max(1, len(durations)):.1f} per sync)')
+
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Sets of accounts (followers, follows...) kept in memory and on disk, shared by all bots.
+#
+# Asking the network who follows us means paging through the whole list, which is too slow and too expensive in API
+# calls to do per post. Bots keep the answer in an AccountSet instead: loaded from a small JSON file on start, updated
+# as follow events come in, and reconciled with the network now and then with replace().
+
+import json
+import logging
+import os
+import threading
+import time
+
+L = logging.getLogger('accounts')
+
+class AccountSet(object):
+    """A persistent mapping of account handles to ids (or whatever the bot needs to act on them)."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.accounts = {}
+        # when we last got the whole set from the network, 0 if never.
+        self.updated = 0
+        self.lock = threading.Lock()
+        # saves come from several threads (follow handlers, the periodic refresh); one at a time.
+        self.saving = threading.Lock()
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            L.warning(f"Couldn't load accounts from {self.path}, starting empty: {e}")
+            return
+        with self.lock:
+            self.accounts = data.get('accounts', {})
+            self.updated = data.get('updated', 0)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.saving:
+            # taken under saving, so the last save to finish has the latest data.
+            with self.lock:
+                data = {'updated': self.updated, 'accounts': dict(self.accounts)}
+            # write and rename, so a crash never leaves us with half a file.
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                L.warning(f"Couldn't save accounts to {self.path}: {e}")
+
+    def age(self):
+        return time.time() - self.updated
+
+    def __contains__(self, handle):
+        with self.lock:
+            return handle in self.accounts
+
+    def __len__(self):
+        with self.lock:
+            return len(self.accounts)
+
+    def get(self, handle, default=None):
+        with self.lock:
+            return self.accounts.get(handle, default)
+
+    def items(self):
+        with self.lock:
+            return list(self.accounts.items())
+
+    def handles(self):
+        with self.lock:
+            return set(self.accounts)
+
+    def add(self, handle, id=None):
+        """Returns True if handle wasn't in the set."""
+        with self.lock:
+            new = handle not in self.accounts
+            self.accounts[handle] = id
+        return new
+
+    def discard(self, handle):
+        """Returns True if handle was in the set."""
+        with self.lock:
+            return self.accounts.pop(handle, False) is not False
+
+    def replace(self, accounts):
+        """Replaces the whole set with accounts ({handle: id}), as just fetched. Returns (added, removed) handles."""
+        with self.lock:
+            added = set(accounts) - set(self.accounts)
+            removed = set(self.accounts) - set(accounts)
+            self.accounts = dict(accounts)
+            self.updated = time.time()
+        return added, removed
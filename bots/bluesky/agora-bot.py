@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import logging
 import os
 import re
+import sys
+import threading
 import time
-import subprocess
 import urllib
 import yaml
 
+# shared code for all bots lives in the parent directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import accounts
+import links
+import metrics
+import ratelimit
+import stream
+
+# next to this file.
+import jetstream
+
 # #go https://github.com/MarshalX/atproto
 from atproto import Client, client_utils, models
 
@@ -17,6 +30,18 @@ parser.add_argument('--config', dest='config', type=argparse.FileType('r'), requ
 parser.add_argument('--verbose', dest='verbose', type=bool, default=False, help='Whether to log more information.')
 parser.add_argument('--output-dir', dest='output_dir', required=True, help='The path to a directory where data will be dumped as needed. If it does not exist, we will try to create it.')
 parser.add_argument('--write', dest='write', action="store_true", help='Whether to actually post (default, when this is off, is dry run.')
+parser.add_argument('--followers', dest='followers', default='followers.json', help='The path to a cache of our followers, can be non-existent; we\'ll write there.')
+parser.add_argument('--follows', dest='follows', default='follows.json', help='The path to a cache of who we follow, can be non-existent; we\'ll write there.')
+parser.add_argument('--reconcile-interval', dest='reconcile_interval', type=int, default=3600, help='How often to fetch the full lists of followers and follows to catch unfollows, in seconds; in between we only look for new ones.')
+parser.add_argument('--stream', dest='stream', action="store_true", help='Whether to handle posts as they happen (from jetstream) instead of polling mutuals every minute.')
+parser.add_argument('--jetstream', dest='jetstream', default=jetstream.JETSTREAM, help='The jetstream instance to use with --stream.')
+parser.add_argument('--cursor', dest='cursor', default='cursor.json', help='The path to a file recording how far into the stream we got, can be non-existent; we\'ll write there. Lets --stream resume after a restart.')
+parser.add_argument('--refresh', dest='refresh', type=int, default=600, help='With --stream, how often to follow back and update the list of accounts we listen to, in seconds.')
+parser.add_argument('--record', dest='record', help='With --stream, append every event seen to this file (for --replay).')
+parser.add_argument('--replay', dest='replay', help='Read jetstream events from this file (one JSON event per line) instead of the network. Without --write, this runs entirely offline.')
+parser.add_argument('--metrics', dest='metrics', help='The path to a JSON file to periodically dump event counters to, for the bridge api (/metrics, /status).')
+parser.add_argument('--links', dest='links', default='links.db', help='The path to an sqlite index of links already logged to nodes, can be non-existent; we\'ll create it.')
+parser.add_argument('--rebuild-links', dest='rebuild_links', action="store_true", help='Whether to rebuild the links index from the Markdown in the stream on start.')
 args = parser.parse_args()
 
 WIKILINK_RE = re.compile(r'\[\[(.*?)\]\]', re.IGNORECASE)
@@ -24,6 +49,9 @@ WIKILINK_RE = re.compile(r'\[\[(.*?)\]\]', re.IGNORECASE)
 HASHTAG_RE = re.compile(r'#<span>(\w+)</span>', re.IGNORECASE)
 # https://github.com/bluesky-social/atproto/discussions/2523
 URI_RE = re.compile(r'at://(.*?)/app.bsky.feed.post/(.*)', re.IGNORECASE)
+# Bluesky allows 3000 requests per 5 minutes, and 5000 points worth of writes per hour (creating a record is 3 points).
+BUDGETS = {'api': (3000, 300), 'write': (1666, 3600)}
+WRITES = ['send_post', 'follow', 'like', 'repost']
 
 logging.basicConfig()
 L = logging.getLogger('agora-bot')
@@ -32,20 +60,17 @@ if args.verbose:
 else:
     L.setLevel(logging.INFO)
 
+METRICS = metrics.Metrics('bluesky', args.metrics)
+STREAM = stream.StreamWriter(args.output_dir)
+LIMITER = ratelimit.RateLimiter(BUDGETS, metrics=METRICS)
+LINKS = links.LinkIndex(args.links)
+
 def uniq(l):
     # also orders, because actually it works better.
     # return list(OrderedDict.fromkeys(l))
     # only works for hashable items
     return sorted(list(set(l)), key=str.casefold)
 
-def mkdir(string):
-    if not os.path.isdir(string):
-        print(f"Trying to create {string}.")
-        output = subprocess.run(['mkdir', '-p', string], capture_output=True)
-        if output.stderr:
-            L.error(output.stderr)
-    return os.path.abspath(string)
-
 
 
 class AgoraBot(object):
@@ -56,7 +81,21 @@ class AgoraBot(object):
         except yaml.YAMLError as e:
             L.error(e)
 
-        self.client = Client(base_url='https://bsky.social')
+        if args.rebuild_links or LINKS.empty():
+            LINKS.rebuild(os.path.join(args.output_dir, self.config['user']))
+
+        # did -> handle, see refresh_graph().
+        self.followers = accounts.AccountSet(args.followers)
+        self.follows = accounts.AccountSet(args.follows)
+
+        if args.replay and not args.write:
+            L.info('Replaying without --write, not logging in.')
+            self.client = None
+            return
+
+        # atproto errors carry the response, with Bluesky's ratelimit-* headers; see bots/ratelimit.py.
+        self.client = ratelimit.RateLimited(Client(base_url='https://bsky.social'), LIMITER,
+                bucket=lambda name: 'write' if name in WRITES else 'api', namespaces=['app'])
         self.client.login(self.config['user'], self.config['password'])
 
         self.me = self.client.resolve_handle(self.config['user'])
@@ -93,103 +132,140 @@ class AgoraBot(object):
                 node = os.path.split(node)[-1]
 
             # TODO: update username after refactoring.
-            bot_stream_dir = mkdir(os.path.join(args.output_dir, self.config['user']))
-            bot_stream_filename = os.path.join(bot_stream_dir, node + '.md')
+            bot_stream_filename = os.path.join(self.config['user'], node + '.md')
 
-            # dedup logic.
-            try:
-                with open(bot_stream_filename, 'r') as note:
-                    note = note.read()
-                    L.info(f"In note: {note}.")
-                    if note and url in note:
-                        L.info("Post already logged to note.")
-                        return False
-                    else:
-                        if args.write:
-                            L.info("Post will be logged to note.")
-            except FileNotFoundError:
-                pass
-
-            # try to append.
-            try:
-                if args.write:
-                    with open(bot_stream_filename, 'a') as note:
-                        note.write(f"- [[{post.indexed_at}]] @[[{post.author.handle}]]: {url}\n")
-            except:
-                L.error("Couldn't log post to note.")
+            # dedup logic, see bots/links.py. we only record links we actually write.
+            if LINKS.has(node, url) or (args.write and not LINKS.add(node, url)):
+                L.info("Post already logged to note.")
                 return False
 
+            # append (buffered, see bots/stream.py).
+            if args.write:
+                L.info("Post will be logged to note.")
+                STREAM.append(bot_stream_filename, f"- [[{post.indexed_at}]] @[[{post.author.handle}]]: {url}\n",
+                        done=functools.partial(LINKS.logged, node, url))
+
         return True
         
     def maybe_reply(self, uri, post, msg, entities):
         L.info(f'Would reply to {post} with {msg.build_text()}')
-        ref = models.create_strong_ref(post)
+        METRICS.incr('handled')
         if args.write:
+            ref = models.create_strong_ref(post)
             # Only actually write if we haven't written before (from the PoV of the current agora).
             # log_post should return false if we have already written a link to node previously.
             if self.log_post(uri, post, entities):
                 self.client.send_post(msg, reply_to=models.AppBskyFeedPost.ReplyRef(parent=ref, root=ref))
+                METRICS.incr('replies')
         else:
-            L.info(f'Skipping replying due to dry_run. Pass --write to actually write.')
-
-    def get_followers(self):
-        return self.client.get_followers(self.config['user'])['followers']
-
-    def get_follows(self):
-        return self.client.get_follows(self.config['user'])['follows']
+            L.info('Skipping replying due to dry_run. Pass --write to actually write.')
+
+    def fetch_graph(self, method, key, known=None):
+        """Pages through our followers or follows, returning {did: handle}.
+
+        With known (a set of DIDs), stops at the first page with someone we already knew: the lists are newest first,
+        so that gets whoever was added since we last looked, usually in one call.
+        """
+        found = {}
+        cursor = None
+        while True:
+            response = method(self.config['user'], cursor=cursor, limit=100)
+            page = {profile.did: profile.handle for profile in getattr(response, key)}
+            found.update(page)
+            cursor = response.cursor
+            if not cursor or not page or (known is not None and set(page) & known):
+                return found
+
+    def refresh_graph(self, full=False):
+        """Brings the followers and follows caches up to date.
+
+        New accounts are picked up incrementally; once every --reconcile-interval (or with full) we fetch both lists
+        in full, which is how we notice unfollows.
+        """
+        for cache, method, key in ((self.followers, self.client.get_followers, 'followers'),
+                                   (self.follows, self.client.get_follows, 'follows')):
+            if full or cache.age() > args.reconcile_interval:
+                added, removed = cache.replace(self.fetch_graph(method, key))
+                L.info(f'-> Fetched {len(cache)} {key}: {len(added)} new, {len(removed)} gone.')
+            else:
+                added = [did for did, handle in self.fetch_graph(method, key, cache.handles()).items()
+                         if cache.add(did, handle)]
+                L.info(f'-> {len(added)} new {key}.')
+            cache.save()
+        METRICS.set('followers', len(self.followers))
 
     def get_mutuals(self):
         # Note we'll return a set of DIDs (type hints to the rescue? eventually... :))
-        mutuals = set()
-        follows = self.get_follows()
-        followers = self.get_followers()
-        for follower in followers: 
-            if follower.did in [f.did for f in follows]:
-                # Ahoy matey!
-                mutuals.add(follower.did)
-
-        # This is no longer needed but remains an example of working with cursors.
-        #    cursor = ''
-        #    # This work but it is quite inefficient to check for mutualness as some accounts follow *a lot* of people.
-        #    while True:
-        #        L.info(f'Processing following list for {follower.handle} with cursor {cursor}')
-        #        follows = self.client.get_follows(follower.did, limit=100, cursor=cursor)
-        #        for following in follows:
-        #            if following[0] == 'follows':
-        #                for follow in following[1]:
-        #                    # L.info(f'{follow.did}')
-        #                    if follow.did == self.me.did:
-        #                        # Ahoy matey!
-        #                        L.info(f'{follower.handle} follows us!')
-        #                        mutuals.add(follower.did)
-        #        cursor = follows.cursor
-        #        if not cursor:
-        #           break 
-
-        return mutuals
+        return self.followers.handles() & self.follows.handles()
 
     def follow_followers(self):
-        for follower in self.get_followers():
-            if follower.did in self.get_mutuals():
-                L.info(f'-> We already follow {follower.handle}')
-            else:
-                L.info(f'-> Trying to follow back {follower.handle}')
-                self.client.follow(follower.did)
+        self.refresh_graph()
+        for did, handle in self.followers.items():
+            if did in self.follows:
+                continue
+            L.info(f'-> Trying to follow back {handle}')
+            self.client.follow(did)
+            self.follows.add(did, handle)
+            self.follows.save()
 
     def catch_up(self):
         for mutual_did in self.get_mutuals():
             L.info(f'-> Processing posts by {mutual_did}...')
             posts = self.client.app.bsky.feed.post.list(mutual_did, limit=100)
             for uri, post in posts.records.items():
-                wikilinks = WIKILINK_RE.findall(post.text)
-                if wikilinks:
-                    entities = uniq(wikilinks)
-                    L.info(f'\nSaw wikilinks at {uri}:\n{post.text}\n')
-                    msg = self.build_reply(entities)
-                    L.info(f'\nWould respond with:\n{msg.build_text()}\n--\n')
-                    # atproto somehow needs this kind of post and not the... other?
-                    actual_post = self.client.get_posts([uri]).posts[0]
-                    self.maybe_reply(uri, actual_post, msg, entities)
+                METRICS.incr('events')
+                self.handle_post(uri, post.text)
+
+    def handle_post(self, uri, text):
+        wikilinks = WIKILINK_RE.findall(text)
+        if wikilinks:
+            entities = uniq(wikilinks)
+            L.info(f'\nSaw wikilinks at {uri}:\n{text}\n')
+            msg = self.build_reply(entities)
+            L.info(f'\nWould respond with:\n{msg.build_text()}\n--\n')
+            # atproto somehow needs this kind of post and not the... other?
+            actual_post = self.client.get_posts([uri]).posts[0] if self.client else None
+            self.maybe_reply(uri, actual_post, msg, entities)
+
+    def keep_following(self, events):
+        """With --stream: follows back and updates whose posts we get every --refresh seconds."""
+        while True:
+            time.sleep(args.refresh)
+            try:
+                self.follow_followers()
+                self.mutuals = self.get_mutuals()
+                events.set_dids(self.mutuals)
+            except Exception:
+                L.exception("Couldn't refresh followers.")
+                METRICS.incr('errors')
+
+    def stream(self):
+        """Handles posts by mutuals as they happen, from jetstream or a --replay file. Doesn't return unless replaying."""
+        self.mutuals = self.get_mutuals()
+        if args.replay:
+            cursor = None
+            events = jetstream.replay(args.replay)
+        else:
+            cursor = jetstream.Cursor(args.cursor)
+            events = jetstream.Jetstream(args.jetstream, self.mutuals, cursor, args.record)
+            threading.Thread(target=self.keep_following, args=(events,), daemon=True, name='follow').start()
+        try:
+            for uri, cid, did, record in jetstream.posts(events, cursor):
+                METRICS.incr('events')
+                METRICS.set('last_event', time.time())
+                # jetstream should only send us these, but never reply to strangers. replaying offline (no --write, not
+                # logged in) is the only time we look at posts by anyone.
+                if self.client and did not in self.mutuals:
+                    L.debug(f'Skipping {uri}, not by a mutual.')
+                    continue
+                try:
+                    self.handle_post(uri, record.get('text', ''))
+                except Exception:
+                    L.exception(f"Couldn't handle {uri}.")
+                    METRICS.incr('errors')
+        finally:
+            if cursor:
+                cursor.save()
 
 def main():
     # How much to sleep between runs, in seconds (this may go away once we're using a subscription model?).
@@ -197,9 +273,20 @@ def main():
 
     bot = AgoraBot()
 
+    if args.stream or args.replay:
+        if bot.client:
+            bot.follow_followers()
+        bot.stream()
+        return
+
     while True:
-        bot.follow_followers()
-        bot.catch_up()
+        try:
+            bot.follow_followers()
+            bot.catch_up()
+        except Exception:
+            METRICS.incr('errors')
+            raise
+        METRICS.set('last_event', time.time())
 
         L.info(f'-> Sleeping for {sleep} seconds...')
         time.sleep(sleep)
@@ -0,0 +1,188 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Bluesky posts as they happen, from [[jetstream]] (a JSON version of the atproto firehose), for agora-bot.py --stream.
+#
+# We ask Jetstream only for posts by the accounts we care about (mutuals), and remember how far we got (the time_us
+# of the last event handled, see Cursor) so a restart resumes where we left off instead of missing or redoing posts.
+# Events can also be read from a file with one event per line (--replay), e.g. one written by --record, which lets
+# the bot be tried without touching the network.
+#
+# See https://github.com/bluesky-social/jetstream for the protocol.
+
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    # comes with atproto.
+    from websockets.sync.client import connect
+except ImportError:
+    connect = None
+
+L = logging.getLogger('jetstream')
+
+JETSTREAM = 'wss://jetstream2.us-east.bsky.network/subscribe'
+COLLECTION = 'app.bsky.feed.post'
+# jetstream allows filtering on up to this many DIDs. Note that no DIDs at all means *every* account to jetstream, so
+# we never ask for that: with nobody to listen to we stay disconnected.
+MAX_DIDS = 10000
+# how often to save the cursor, in seconds.
+CURSOR_INTERVAL = 5
+# go back this far when resuming, in microseconds, in case the last events before a crash didn't make it; the bot
+# dedups posts so seeing some twice is fine.
+REWIND = 5 * 1000000
+BACKOFF = 1
+BACKOFF_MAX = 60
+
+class Cursor(object):
+    """The time_us of the last event handled, kept in a small JSON file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.value = None
+        self.saved = 0
+        if path:
+            try:
+                with open(path, 'r') as f:
+                    self.value = json.load(f).get('time_us')
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                L.warning(f"Couldn't load cursor from {path}, starting from now: {e}")
+
+    def set(self, value):
+        self.value = value
+        if time.time() - self.saved > CURSOR_INTERVAL:
+            self.save()
+
+    def save(self):
+        if not self.path or self.value is None:
+            return
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'time_us': self.value}, f)
+            os.replace(tmp, self.path)
+            self.saved = time.time()
+        except OSError as e:
+            L.warning(f"Couldn't save cursor to {self.path}: {e}")
+
+class Jetstream(object):
+    """Yields Jetstream events for posts by dids, reconnecting (and resuming from cursor) as needed."""
+
+    def __init__(self, url=JETSTREAM, dids=(), cursor=None, record=None):
+        if connect is None:
+            raise RuntimeError('--stream needs websockets: pip install websockets (atproto should have brought it in).')
+        self.url = url
+        self.dids = wanted(dids)
+        # set while there is anyone to listen to.
+        self.listening = threading.Event()
+        if self.dids:
+            self.listening.set()
+        self.cursor = cursor or Cursor()
+        self.record = open(record, 'a') if record else None
+        self.ws = None
+        self.lock = threading.Lock()
+
+    def options(self):
+        return json.dumps({'type': 'options_update', 'payload': {
+            'wantedCollections': [COLLECTION], 'wantedDids': self.dids, 'maxMessageSizeBytes': 0}})
+
+    def set_dids(self, dids):
+        """Changes whose posts we want, e.g. as mutuals come and go. Takes effect right away."""
+        dids = wanted(dids)
+        with self.lock:
+            if dids == self.dids:
+                return
+            self.dids = dids
+            if not dids:
+                L.warning('Nobody to listen to anymore, disconnecting from jetstream.')
+                self.listening.clear()
+                if self.ws:
+                    self.ws.close()
+                return
+            self.listening.set()
+            if self.ws:
+                try:
+                    self.ws.send(self.options())
+                except Exception as e:
+                    # the next connection will send them anyway.
+                    L.info(f"Couldn't update jetstream options: {e}")
+
+    def connect(self):
+        # with requireHello the server sends nothing until we've told it what we want, as the list of DIDs can be too
+        # long for the url.
+        url = f'{self.url}?wantedCollections={COLLECTION}&requireHello=true'
+        if self.cursor.value:
+            url += f'&cursor={self.cursor.value - REWIND}'
+        L.info(f'Connecting to {url} for {len(self.dids)} accounts.')
+        ws = connect(url, open_timeout=30, max_size=None)
+        with self.lock:
+            if not self.dids:
+                ws.close()
+                raise RuntimeError('nobody to listen to')
+            ws.send(self.options())
+            self.ws = ws
+        return ws
+
+    def __iter__(self):
+        backoff = BACKOFF
+        while True:
+            if not self.listening.is_set():
+                L.info('Waiting for someone to listen to.')
+                self.listening.wait()
+            try:
+                ws = self.connect()
+                for message in ws:
+                    backoff = BACKOFF
+                    if self.record:
+                        self.record.write(message.rstrip('\n') + '\n')
+                        self.record.flush()
+                    yield json.loads(message)
+            except Exception as e:
+                L.warning(f'Jetstream connection lost ({e}), reconnecting in {backoff}s.')
+            finally:
+                with self.lock:
+                    self.ws = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX)
+
+def wanted(dids):
+    dids = sorted(dids)
+    if len(dids) > MAX_DIDS:
+        L.warning(f'Jetstream only takes {MAX_DIDS} DIDs, not listening to {len(dids) - MAX_DIDS} of {len(dids)} accounts.')
+    return dids[:MAX_DIDS]
+
+def replay(path):
+    """Yields the events in a file with one JSON event per line, as written by --record."""
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def posts(events, cursor=None):
+    """Yields (uri, cid, did, record) for new posts among events, advancing cursor as it goes.
+
+    The cursor is advanced when the next event is asked for, i.e. after the caller is done with a post.
+    """
+    for event in events:
+        commit = event.get('commit') or {}
+        if event.get('kind') == 'commit' and commit.get('operation') == 'create' and commit.get('collection') == COLLECTION:
+            uri = f"at://{event['did']}/{COLLECTION}/{commit['rkey']}"
+            yield uri, commit.get('cid'), event['did'], commit.get('record') or {}
+        if cursor and event.get('time_us'):
+            cursor.set(event['time_us'])
@@ -0,0 +1,107 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Which posts have already been logged to which node, shared by all bots.
+#
+# Bots used to read a whole node file and look for the post's url in it before logging a link, which gets slow for
+# busy nodes like [[agora]]. This keeps (node, url) pairs in sqlite (--links in each bot) instead. The Markdown in the
+# stream is still the source of truth: the index can be rebuilt from it at any time (--rebuild-links), and is built
+# automatically the first time a bot runs with an empty one.
+#
+# To keep it that way, a link only goes into sqlite once the line logging it is on disk (see the done callback of
+# StreamWriter.append() in bots/stream.py); until then it's kept in memory, so it's still deduped.
+
+import glob
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+L = logging.getLogger('links')
+
+SCHEMA = """
+create table if not exists links (
+    node text not null,
+    url text not null,
+    added real,
+    primary key (node, url)
+);
+"""
+
+# anything that looks like a link to a post in a node file written by a bot.
+URL_RE = re.compile(r'https?://[^\s<>()\'"]+')
+
+class LinkIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        # the mastodon bot handles events in the streaming thread.
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # (node, url) pairs being logged, i.e. waiting for the stream to be flushed.
+        self.pending = set()
+
+    def empty(self):
+        with self.lock:
+            return self.db.execute('select 1 from links limit 1').fetchone() is None
+
+    def has(self, node, url):
+        with self.lock:
+            return (node, url) in self.pending or self.known(node, url)
+
+    def known(self, node, url):
+        return self.db.execute('select 1 from links where node = ? and url = ?', (node, url)).fetchone() is not None
+
+    def add(self, node, url):
+        """Notes that url is being logged to node. Returns False if it already was.
+
+        Call logged() once it's on disk.
+        """
+        with self.lock:
+            if (node, url) in self.pending or self.known(node, url):
+                return False
+            self.pending.add((node, url))
+        return True
+
+    def logged(self, node, url):
+        """Records that url was logged to node, see add()."""
+        with self.lock, self.db:
+            self.db.execute('insert or ignore into links (node, url, added) values (?, ?, ?)', (node, url, time.time()))
+            self.pending.discard((node, url))
+
+    def rebuild(self, path):
+        """Replaces the index with the links found in the node files (*.md) under path."""
+        pairs = set()
+        for filename in glob.glob(os.path.join(glob.escape(path), '*.md')):
+            node = os.path.basename(filename)[:-len('.md')]
+            try:
+                with open(filename, 'r') as note:
+                    for url in URL_RE.findall(note.read()):
+                        pairs.add((node, url))
+            except OSError as e:
+                L.warning(f"Couldn't read {filename}: {e}")
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('delete from links')
+            self.db.executemany('insert or ignore into links (node, url, added) values (?, ?, ?)',
+                    [(node, url, now) for node, url in pairs])
+        L.info(f'Indexed {len(pairs)} links from {path}.')
+        return len(pairs)
+
+    def close(self):
+        self.db.close()
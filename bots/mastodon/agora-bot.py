@@ -16,31 +16,49 @@
 # an [[agora bridge]], that is, a utility that takes a .yaml file describing a set of [[personal knowledge graphs]] or [[digital gardens]] and pulls them to be consumed by other bridges or an [[agora server]]. [[flancian]]
 
 import argparse
+import concurrent.futures
+import functools
 import glob
 import logging
 import os
 import subprocess
 import random
 import re
+import sys
+import threading
 import time
 import urllib
 import yaml
 
 from collections import OrderedDict
 from datetime import datetime
-from mastodon import Mastodon, StreamListener, MastodonAPIError, MastodonNetworkError
+from mastodon import Mastodon, StreamListener, MastodonError, MastodonAPIError, MastodonNetworkError, MastodonRatelimitError
 
 # [[2022-11-17]]: changing approaches, bots should write by calling an Agora API; direct writing to disk was a hack.
 # common.py should have the methods to write resources to a node in any case.
 # (maybe direct writing to disk can remain as an option, as it's very simple and convenient if people are running local agoras?).
 import common
 
+# shared code for all bots lives in the parent directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import accounts
+import links
+import membership
+import metrics
+import pipeline
+import ratelimit
+import stream
+
 WIKILINK_RE = re.compile(r'\[\[(.*?)\]\]', re.IGNORECASE)
 # thou shall not use regexes to parse html, except when yolo
 HASHTAG_RE = re.compile(r'#<span>(\w+)</span>', re.IGNORECASE)
 PUSH_RE = re.compile(r'\[\[push\]\]', re.IGNORECASE)
 # Buggy, do not enable without revamping build_reply()
 P_HELP = 0.0
+# Mastodon's default budget: 300 calls per 5 minutes, per account, for (almost) everything.
+BUDGETS = {'api': (300, 300)}
+# how many pages of statuses (of 40) to catch up on per account and run, at most.
+CATCH_UP_PAGES = 5
 
 parser = argparse.ArgumentParser(description='Agora Bot for Mastodon (ActivityPub).')
 parser.add_argument('--config', dest='config', type=argparse.FileType('r'), required=True, help='The path to agora-bot.yaml, see agora-bot.yaml.example.')
@@ -48,6 +66,15 @@ parser.add_argument('--verbose', dest='verbose', type=bool, default=False, help=
 parser.add_argument('--output-dir', dest='output_dir', required=True, help='The path to a directory where data will be dumped as needed. If it does not exist, we will try to create it.')
 parser.add_argument('--dry-run', dest='dry_run', action="store_true", help='Whether to refrain from posting or making changes.')
 parser.add_argument('--catch-up', dest='catch_up', action="store_true", help='Whether to run code to catch up on missed toots (e.g. because we were down for a bit, or because this is a new bot instance.')
+parser.add_argument('--catch-up-workers', dest='catch_up_workers', type=int, default=4, help='How many accounts to catch up on concurrently.')
+parser.add_argument('--checkpoints', dest='checkpoints', default='checkpoints.json', help='The path to a file recording the latest status we have seen by each follower, can be non-existent; we\'ll write there. Lets --catch-up pick up where it left off.')
+parser.add_argument('--metrics', dest='metrics', help='The path to a JSON file to periodically dump event counters to, for the bridge api (/metrics, /status).')
+parser.add_argument('--followers', dest='followers', default='followers.json', help='The path to a cache of our followers, can be non-existent; we\'ll write there.')
+parser.add_argument('--reconcile-interval', dest='reconcile_interval', type=int, default=3600, help='How often to fetch the full list of followers to catch changes we were not notified about (e.g. unfollows), in seconds.')
+parser.add_argument('--workers', dest='workers', type=int, default=pipeline.WORKERS, help='How many statuses to handle concurrently.')
+parser.add_argument('--max-queued', dest='max_queued', type=int, default=pipeline.MAX_QUEUED, help='How many statuses can wait for a worker before we stop reading the stream.')
+parser.add_argument('--links', dest='links', default='links.db', help='The path to an sqlite index of links already logged to nodes, can be non-existent; we\'ll create it.')
+parser.add_argument('--rebuild-links', dest='rebuild_links', action="store_true", help='Whether to rebuild the links index from the Markdown in the stream on start.')
 args = parser.parse_args()
 
 logging.basicConfig()
@@ -57,6 +84,11 @@ if args.verbose:
 else:
     L.setLevel(logging.INFO)
 
+METRICS = metrics.Metrics('mastodon', args.metrics)
+STREAM = stream.StreamWriter(args.output_dir)
+LIMITER = ratelimit.RateLimiter(BUDGETS, metrics=METRICS)
+LINKS = links.LinkIndex(args.links)
+
 def slugify(wikilink):
     # As of 2022-07 or so we're not slugifying anymore, but rather quote_plusing.
     # trying to keep it light here for simplicity, wdyt?
@@ -88,10 +120,21 @@ class AgoraBot(StreamListener):
         StreamListener.__init__(self)
         self.mastodon = mastodon
         self.bot_username = bot_username
+        # acct -> account id. Mastodon doesn't tell us about unfollows, so this gets reconciled now and then.
+        self.followers = accounts.AccountSet(args.followers)
+        # who is mentioned in which node (opt in, push...) of our stream.
+        self.members = membership.MembershipIndex(STREAM, bot_username)
+        # statuses are handled here rather than in the streaming thread; see node_keys() for ordering.
+        self.pipeline = pipeline.Pipeline(args.workers, args.max_queued, METRICS)
+        # set when we're exiting, so catch-up stops between pages instead of going through every follower first.
+        self.stopping = threading.Event()
+        if args.rebuild_links or LINKS.empty():
+            LINKS.rebuild(os.path.join(args.output_dir, bot_username))
         L.info(f'[[agora bot]] for {bot_username} started!')
 
     def send_toot(self, msg, in_reply_to_id=None):
         L.info('sending toot.')
+        METRICS.incr('replies')
         status = self.mastodon.status_post(msg, in_reply_to_id=in_reply_to_id)
 
     def boost_toot(self, id):
@@ -108,9 +151,8 @@ class AgoraBot(StreamListener):
         if status.mentions:
             # if other people are mentioned in the thread, only at mention them if they also follow us.
             # see https://social.coop/@flancian/108153868738763998 for reasoning.
-            followers = [x['acct'] for x in self.get_followers()]
             for mention in status.mentions:
-                if mention['acct'] in followers:
+                if mention['acct'] in self.followers:
                     mentions += f"@{mention['acct']} "
 
         lines.append(mentions)
@@ -134,32 +176,20 @@ class AgoraBot(StreamListener):
                 # for now, dump only to the last path fragment -- this yields the right behaviour in e.g. [[go/cat-tournament]]
                 node = os.path.split(node)[-1]
 
-            bot_stream_dir = common.mkdir(os.path.join(args.output_dir, self.bot_username))
-            bot_stream_filename = os.path.join(bot_stream_dir, node + '.md')
+            bot_stream_filename = os.path.join(self.bot_username, node + '.md')
 
-            # dedup logic.
-            try:
-                with open(bot_stream_filename, 'r') as note:
-                    note = note.read()
-                    L.info(f"Note: {note}.")
-                    # why both? it has been lost to the mists of time, or maybe the commit log :)
-                    # perhaps uri is what's set in pleroma?
-                    if note and (toot.url or toot.uri) in note:
-                        L.info("Toot already logged to note.")
-                        return False
-                    else:
-                        L.info("Toot will be logged to note.")
-            except FileNotFoundError:
-                pass
-
-            # try to append.
-            try:
-                with open(bot_stream_filename, 'a') as note:
-                    url = toot.url or toot.uri
-                    note.write(f"- [[{toot.account.acct}]] {url}\n")
-            except: 
-                L.error("Couldn't log toot to note.")
+            # dedup logic, see bots/links.py.
+            # why both? it has been lost to the mists of time, or maybe the commit log :)
+            # perhaps uri is what's set in pleroma?
+            url = toot.url or toot.uri
+            if not LINKS.add(node, url):
+                L.info("Toot already logged to note.")
                 return False
+            L.info("Toot will be logged to note.")
+
+            # append (buffered, see bots/stream.py); the link is only recorded once it's on disk.
+            STREAM.append(bot_stream_filename, f"- [[{toot.account.acct}]] {url}\n",
+                    done=functools.partial(LINKS.logged, node, url))
         return True
 
     def write_toot(self, toot, nodes):
@@ -175,20 +205,12 @@ class AgoraBot(StreamListener):
             return False
         L.info(f"User {username} has opted in to writing, pushing (publishing) full post text to an Agora.")
 
-        user_stream_dir = common.mkdir(os.path.join(args.output_dir, username))
-
+        url = toot.url or toot.uri
         for node in nodes:
-            user_stream_filename = os.path.join(user_stream_dir, node + '.md')
-            try:
-                with open(user_stream_filename, 'a') as note:
-                    url = toot.url or toot.uri
-                    note.write(f"- [[{toot.created_at}]] @[[{username}]] (<a href='{url}'>link</a>):\n  - {toot.content}\n")
-            except:
-                L.error("Couldn't log full post to note in user stream.")
-                return
+            user_stream_filename = os.path.join(username, node + '.md')
+            STREAM.append(user_stream_filename, f"- [[{toot.created_at}]] @[[{username}]] (<a href='{url}'>link</a>):\n  - {toot.content}\n")
 
     def is_mentioned_in(self, username, node):
-        # TODO: fix this.
         if not args.output_dir:
             return False
 
@@ -196,20 +218,11 @@ class AgoraBot(StreamListener):
             # for now, dump only to the last path fragment -- this yields the right behaviour in e.g. [[go/cat-tournament]]
             node = os.path.split(node)[-1]
 
-        agora_stream_dir = common.mkdir(os.path.join(args.output_dir, self.bot_username))
-        filename = os.path.join(agora_stream_dir, node + '.md')
-        L.info(f"Checking if {username} is mentioned in {node} meaning {filename}.")
-
-        try:
-            with open(filename, 'r') as note:
-                if f'[[{username}]]' in note.read():
-                    L.info(f"User {username} is mentioned in {node}.")
-                    return True
-                else:
-                    L.info(f"User {username} not mentioned in {node}.")
-                    return False
-        except FileNotFoundError:
-            return False
+        if self.members.is_mentioned_in(username, node):
+            L.info(f"User {username} is mentioned in {node}.")
+            return True
+        L.info(f"User {username} not mentioned in {node}.")
+        return False
 
     def wants_writes(self, user):
         # Allowlist to begin testing? :)
@@ -231,6 +244,7 @@ class AgoraBot(StreamListener):
             L.info(f"-> not replying due to dry run, message would be: {msg}")
             return False
 
+        METRICS.incr('handled')
         # we use the log as a database :)
         if self.log_toot(status, entities):
             self.send_toot(msg, status.id)
@@ -250,10 +264,27 @@ class AgoraBot(StreamListener):
             batch = self.mastodon.fetch_next(batch)
         return followers
 
+    def reconcile_followers(self):
+        """Fetches the full list of followers and replaces our cached one with it."""
+        added, removed = self.followers.replace({user.acct: user.id for user in self.get_followers()})
+        self.followers.save()
+        METRICS.set('followers', len(self.followers))
+        L.info(f'reconciled followers: {len(self.followers)} in total, {len(added)} new, {len(removed)} gone.')
+        return added, removed
+
+    def keep_followers(self):
+        while True:
+            time.sleep(max(args.reconcile_interval - self.followers.age(), 60))
+            try:
+                self.reconcile_followers()
+            except Exception:
+                # keep going: we'll try again in a bit, and the cache is still good meanwhile.
+                L.exception("couldn't reconcile followers.")
+                METRICS.incr('errors')
+
     def is_following(self, user):
-        following_accounts = [f['acct'] for f in self.get_followers()]
-        if user not in following_accounts:
-            L.info(f"account {user} not in followers: {following_accounts}.")
+        if user not in self.followers:
+            L.info(f"account {user} not in followers.")
             return False
         return True
 
@@ -336,28 +367,139 @@ class AgoraBot(StreamListener):
     def handle_follow(self, notification):
         """Try to handle live follows of [[agora bot]]."""
         L.info('Got a follow!')
-        mastodon.account_follow(notification.account)
+        account = notification.account
+        if self.followers.add(account.acct, account.id):
+            self.followers.save()
+            METRICS.set('followers', len(self.followers))
+        if args.dry_run:
+            return
+        try:
+            self.mastodon.account_follow(account.id)
+        except MastodonAPIError as e:
+            L.info(f"couldn't follow back {account.acct}: {e}")
 
     def handle_unfollow(self, notification):
         """Try to handle live unfollows of [[agora bot]]."""
+        # Mastodon doesn't currently send these (reconcile_followers() catches unfollows), but other servers might.
         L.info('Got an unfollow!')
-        mastodon.account_follow(notification.account)
+        if self.followers.discard(notification.account.acct):
+            self.followers.save()
+            METRICS.set('followers', len(self.followers))
+
+    def catch_up_account(self, acct, id, checkpoints):
+        """Follows acct back if we never did, and with --catch-up handles statuses they posted since we last looked."""
+        if self.stopping.is_set():
+            return
+        last = checkpoints.get(acct)
+        if acct not in checkpoints:
+            L.info(f'trying to follow back {acct}')
+            try:
+                self.mastodon.account_follow(id)
+            except MastodonError as e:
+                # not recorded, so we try again next time.
+                L.warning(f"couldn't follow back {acct}: {e}")
+                METRICS.incr('errors')
+                return
+            checkpoints.add(acct, None)
+        if not args.catch_up:
+            return
+        # the mastodon API... sigh.
+        # mastodon.timeline() maxes out at 40 toots, no matter what limit we set.
+        #   (this might be a limitation of botsin.space?)
+        # mastodon.list_timeline() looked promising but always comes back empty with no reason.
+        # so we need to iterate per-user in the end. should be OK.
+        for page in range(CATCH_UP_PAGES):
+            if self.stopping.is_set():
+                return
+            L.info(f'fetching toots by user {acct} after {last}')
+            if last:
+                # min_id walks forward from the checkpoint, page by page.
+                statuses = self.mastodon.account_statuses(id, min_id=last, limit=40)
+            else:
+                # never seen this account: just the latest, as before checkpoints.
+                statuses = self.mastodon.account_statuses(id, limit=40)
+            if not statuses:
+                break
+            # newest first, either way. handled through the pipeline like live statuses, so they keep their order
+            # per node; we wait for the page to be done before moving the checkpoint past it.
+            handled = []
+            for status in reversed(statuses):
+                event = threading.Event()
+                # this should handle deduping, so it's safe to always try to reply.
+                self.pipeline.submit(self.node_keys(status), self.catch_up_status, status, event)
+                handled.append(event)
+            for event in handled:
+                event.wait()
+            new = not last
+            last = statuses[0].id
+            checkpoints.add(acct, last)
+            if new or len(statuses) < 40:
+                break
+
+    def catch_up_status(self, status, event):
+        try:
+            self.handle_update(status)
+            METRICS.incr('caught_up')
+        finally:
+            event.set()
+
+    def catch_up(self, followers, checkpoints):
+        """Runs catch_up_account() for all followers, a few at a time."""
+        # accounts we've never looked at first; a run cut short resumes from the checkpoints.
+        followers = sorted(followers, key=lambda follower: follower[0] in checkpoints)
+        METRICS.set('catch_up_pending', len(followers))
+        saved = time.time()
+        executor = concurrent.futures.ThreadPoolExecutor(args.catch_up_workers, thread_name_prefix='catch-up')
+        try:
+            futures = [executor.submit(self.catch_up_account, acct, id, checkpoints) for acct, id in followers]
+            for n, future in enumerate(concurrent.futures.as_completed(futures)):
+                try:
+                    future.result()
+                except MastodonError as e:
+                    L.warning(f"couldn't catch up on an account: {e}")
+                    METRICS.incr('errors')
+                METRICS.set('catch_up_pending', len(followers) - n - 1)
+                if time.time() - saved > 10:
+                    checkpoints.save()
+                    saved = time.time()
+        except BaseException:
+            # e.g. SystemExit on SIGTERM (see bots/stream.py): drop the accounts we haven't started on, and have the
+            # ones in progress stop after their current page.
+            self.stopping.set()
+            raise
+        finally:
+            executor.shutdown(wait=not self.stopping.is_set(), cancel_futures=True)
+            checkpoints.save()
+        L.info(f'caught up with {len(followers)} accounts.')
+
+    def node_keys(self, status):
+        """Returns the node files handling status might append to.
+
+        Statuses sharing any of these are handled in the order they came in; others are handled concurrently.
+        """
+        nodes = WIKILINK_RE.findall(status.content) + HASHTAG_RE.findall(status.content)
+        # same as log_toot().
+        return [os.path.split(node)[-1] for node in nodes]
 
     def on_notification(self, notification):
         # we get this for explicit mentions.
         self.last_read_notification = notification.id
+        METRICS.incr('events')
+        METRICS.set('last_event', time.time())
         if notification.type == 'mention':
-            self.handle_mention(notification.status)
+            self.pipeline.submit(self.node_keys(notification.status), self.handle_mention, notification.status)
         elif notification.type == 'follow':
-            self.handle_follow(notification.status)
+            self.pipeline.submit([('account', notification.account.acct)], self.handle_follow, notification)
         elif notification.type == 'unfollow':
-            self.handle_unfollow(notification.status)
+            self.pipeline.submit([('account', notification.account.acct)], self.handle_unfollow, notification)
         else:
             L.info(f'received unhandled notification type: {notification.type}')
 
     def on_update(self, status):
         # we get this on all activity on our watching list.
-        self.handle_update(status)
+        METRICS.incr('events')
+        METRICS.set('last_event', time.time())
+        self.pipeline.submit(self.node_keys(status), self.handle_update, status)
 
 def get_watching(mastodon):
     now = datetime.now()
@@ -371,15 +513,28 @@ def main():
         L.error(e)
 
     # Set up Mastodon API.
+    # Mastodon.py would wait out rate limits itself, but only once they're hit; we pace calls instead (see bots/ratelimit.py).
     mastodon = Mastodon(
         access_token = config['access_token'],
         api_base_url = config['api_base_url'],
+        ratelimit_method = 'throw',
     )
+    # Mastodon.py keeps the rate limit headers it sees in these.
+    mastodon = ratelimit.RateLimited(mastodon, LIMITER, bucket='api',
+            limited=lambda e: isinstance(e, MastodonRatelimitError),
+            after=lambda api: (api.ratelimit_remaining, api.ratelimit_reset))
 
     bot_username = f"{config['user']}@{config['instance']}"
 
     bot = AgoraBot(mastodon, bot_username)
-    followers = bot.get_followers()
+    # a recent enough cache saves paging through all followers on every restart.
+    if bot.followers.age() > args.reconcile_interval:
+        bot.reconcile_followers()
+    else:
+        L.info(f'using {len(bot.followers)} cached followers.')
+        METRICS.set('followers', len(bot.followers))
+    followers = bot.followers.items()
+    threading.Thread(target=bot.keep_followers, daemon=True, name='followers').start()
     # Now unused?
     watching = get_watching(mastodon)
 
@@ -394,32 +549,12 @@ def main():
         L.info("couldn't clean up list.")
 
     try:
-        mastodon.list_accounts_add(watching, followers)
+        mastodon.list_accounts_add(watching, [id for acct, id in followers])
     except MastodonAPIError as e:
         print("error when trying to add accounts to watching")
         print(f"watching: {watching}")
         print(e)
 
-    for user in followers:
-        L.info(f'trying to follow back {user.acct}')
-        try:
-            mastodon.account_follow(user.id)
-        except MastodonAPIError:
-            pass
-
-        if args.catch_up:
-            L.info(f"trying to catch up with any missed toots for user {user.acct}.")
-            # the mastodon API... sigh.
-            # mastodon.timeline() maxes out at 40 toots, no matter what limit we set.
-            #   (this might be a limitation of botsin.space?)
-            # mastodon.list_timeline() looked promising but always comes back empty with no reason.
-            # so we need to iterate per-user in the end. should be OK.
-            L.info(f'fetching latest toots by user {user.acct}')
-            statuses = mastodon.account_statuses(user['id'], limit=40)
-            for status in statuses:
-                # this should handle deduping, so it's safe to always try to reply.
-                bot.handle_update(status)
-
     # why do we have both? hmm.
     # TODO(flancian): look in commit history or try disabling one.
     # it would be nice to get rid of lists if we can.
@@ -429,6 +564,9 @@ def main():
     # L.info('trying to stream list.')
     # mastodon.stream_list(id=watching.id, listener=bot, run_async=True, reconnect_async=True)
     L.info('now streaming.')
+
+    # follow back and catch up while streaming, so live posts don't wait for this.
+    bot.catch_up(followers, accounts.AccountSet(args.checkpoints))
     while True:
         time.sleep(3600 * 24)
         L.info('[[agora mastodon bot]] is still alive.')
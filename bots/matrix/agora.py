@@ -26,12 +26,14 @@ from maubot.handlers import command
 import datetime
 import os
 import re
+# bots/stream.py, symlinked here so mbc build packs it; listed before agora in maubot.yaml.
+import stream
 
 AGORA_BOT_ID="anagora@matrix.org"
 AGORA_URL=f"https://anagora.org"
 MATRIX_URL=f"https://develop.element.io"
 AGORA_ROOT=os.path.expanduser("~/agora")
-OUTPUT_DIR=f"{AGORA_ROOT}/stream/{AGORA_BOT_ID}"
+STREAM_DIR=f"{AGORA_ROOT}/stream"
 THREAD = RelationType("m.thread")
 # Probably should invest instead in not answering to *spurious* hashtags :)
 HASHTAG_OPT_OUT_ROOMS = [
@@ -41,6 +43,13 @@ HASHTAG_OPT_OUT_ROOMS = [
         ]
 
 class AgoraPlugin(Plugin):
+    async def start(self) -> None:
+        # appends are buffered and written in batches, see bots/stream.py.
+        self.stream = stream.StreamWriter(STREAM_DIR)
+
+    async def stop(self) -> None:
+        self.stream.close()
+
     @command.passive("\[\[(.+?)\]\]", multiple=True)
     async def wikilink_handler(self, evt: MessageEvent, subs: List[Tuple[str, str]]) -> None:
         await evt.mark_read()
@@ -137,11 +146,6 @@ class AgoraPlugin(Plugin):
         # filesystems are move flexible than URLs, spaces are fine and preferred :)
         node = urllib.parse.unquote_plus(node)
 
-        try:
-            os.mkdir(OUTPUT_DIR)
-        except FileExistsError:
-            pass
-
         # unsure if it's OK inlining, perhaps fine in this case as each room does explicit setup?
         msg = evt.content.body
 
@@ -150,20 +154,13 @@ class AgoraPlugin(Plugin):
             # for now, dump only to the last path fragment -- this yields the right behaviour in e.g. [[go/cat-tournament]]
             node = os.path.split(node)[-1]
 
-        filename = os.path.join(OUTPUT_DIR, node + '.md')
+        filename = os.path.join(AGORA_BOT_ID, node + '.md')
         self.log.info(f"logging {evt} to file {filename} mapping to {node}.")
 
         # hack hack -- this should be enabled/disabled/configured in the maubot admin interface somehow?
-        try:
-            with open(filename, 'a') as note:
-                username = evt.sender
-                # /1000 needed to reduce 13 -> 10 digits
-                dt = datetime.datetime.fromtimestamp(int(evt.timestamp/1000))
-                link = f'[link]({MATRIX_URL}/#/room/{evt.room_id}/{evt.event_id})'
-                # note.write(f"- [[{username}]] at {dt}: {link}\n  - ```{msg}```")
-                note.write(f"- [[{dt}]] [[{username}]] ({link}):\n  - {msg}\n")
-        except Exception as e:
-            self.log.info(f"Couldn't save link to message, exception: {e}.")
-
-
-
+        username = evt.sender
+        # /1000 needed to reduce 13 -> 10 digits
+        dt = datetime.datetime.fromtimestamp(int(evt.timestamp/1000))
+        link = f'[link]({MATRIX_URL}/#/room/{evt.room_id}/{evt.event_id})'
+        # note.write(f"- [[{username}]] at {dt}: {link}\n  - ```{msg}```")
+        self.stream.append(filename, f"- [[{dt}]] [[{username}]] ({link}):\n  - {msg}\n")
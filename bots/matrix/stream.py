@@ -0,0 +1 @@
+../stream.py
\ No newline at end of file
@@ -0,0 +1,90 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Who is mentioned in which node of a bot's stream, shared by all bots.
+#
+# Opting in and out of things is done by posting to nodes like [[opt in]], [[push]] or [[nohashtags]]; the bot logs
+# those posts to its stream, so "is this user opted in" means "is [[user]] mentioned in the bot's opt in.md". Bots
+# ask that several times per post, so instead of reading the files each time we keep the users mentioned in each node
+# in memory: a node file is read in full the first time it's asked about, then only what was appended to it since
+# (checked at most every CHECK_INTERVAL seconds). Appends by the bot itself are picked up right away through the
+# StreamWriter in bots/stream.py.
+
+import logging
+import os
+import re
+import threading
+import time
+
+L = logging.getLogger('membership')
+
+WIKILINK_RE = re.compile(r'\[\[(.*?)\]\]', re.IGNORECASE)
+# how often to look for changes made to node files by others, in seconds.
+CHECK_INTERVAL = 30
+
+class MembershipIndex(object):
+
+    def __init__(self, writer, dirname, check_interval=CHECK_INTERVAL):
+        """Indexes node files in dirname, relative to the root of writer (a stream.StreamWriter)."""
+        self.writer = writer
+        self.dirname = dirname
+        self.check_interval = check_interval
+        # node -> {'users': set, 'offset': bytes read from disk, 'inode': ..., 'checked': time}.
+        self.nodes = {}
+        self.lock = threading.Lock()
+        writer.observers.append(self.observe)
+
+    def relpath(self, node):
+        return os.path.join(self.dirname, node + '.md')
+
+    def is_mentioned_in(self, username, node):
+        now = time.time()
+        with self.lock:
+            entry = self.nodes.get(node)
+            if entry is None or now - entry['checked'] > self.check_interval:
+                entry = self.refresh(node, entry, now)
+            return username in entry['users']
+
+    def refresh(self, node, entry, now):
+        relpath = self.relpath(node)
+        try:
+            st = os.stat(self.writer.path(relpath))
+        except FileNotFoundError:
+            st = None
+        if entry is None or st is None or st.st_ino != entry['inode'] or st.st_size < entry['offset']:
+            # first time, or the file was replaced or edited: read it all, including appends still in memory.
+            entry = {'users': set(WIKILINK_RE.findall(self.writer.read(relpath) or '')),
+                     'offset': st.st_size if st else 0, 'inode': st.st_ino if st else None}
+            L.debug(f'Loaded {len(entry["users"])} users mentioned in {node}.')
+        elif st.st_size > entry['offset']:
+            with open(self.writer.path(relpath), 'rb') as f:
+                f.seek(entry['offset'])
+                tail = f.read(st.st_size - entry['offset'])
+            # leave a partially written line for next time.
+            tail = tail[:tail.rfind(b'\n') + 1]
+            entry['users'].update(WIKILINK_RE.findall(tail.decode('utf-8', errors='replace')))
+            entry['offset'] += len(tail)
+        entry['checked'] = now
+        self.nodes[node] = entry
+        return entry
+
+    def observe(self, relpath, text):
+        dirname, filename = os.path.split(relpath)
+        if dirname != self.dirname or not filename.endswith('.md'):
+            return
+        with self.lock:
+            entry = self.nodes.get(filename[:-len('.md')])
+            # nodes we haven't loaded yet will see this when they are.
+            if entry is not None:
+                entry['users'].update(WIKILINK_RE.findall(text))
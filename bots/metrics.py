@@ -0,0 +1,82 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Event counters for [[agora bot]]s, shared by all bots.
+#
+# Bots import this from the parent directory (see the sys.path line at the top of each bot). Counters are dumped
+# periodically to a small JSON file (--metrics in each bot), which the api in the root of this repository reads to
+# serve /metrics and /status.
+
+import json
+import logging
+import os
+import threading
+import time
+
+L = logging.getLogger('metrics')
+
+# how often to write counters to disk, in seconds.
+INTERVAL = 30
+
+class Metrics(object):
+
+    def __init__(self, bot, path=None, interval=INTERVAL):
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        # counters at the last dump, to work out recent rates.
+        self.last = ({}, self.started)
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            threading.Thread(target=self.run, daemon=True, name='metrics').start()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        last, then = self.last
+        elapsed = max(now - then, 1e-6)
+        # events per minute since the last snapshot.
+        rates = {name: (count - last.get(name, 0)) * 60 / elapsed for name, count in counters.items()}
+        self.last = (counters, now)
+        return {'bot': self.bot, 'pid': os.getpid(), 'started': self.started, 'updated': now,
+                'counters': counters, 'gauges': gauges, 'rates': rates}
+
+    def dump(self):
+        # write and rename, so readers never see a partial file.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, self.path)
+
+    def run(self):
+        while True:
+            try:
+                self.dump()
+            except OSError as e:
+                L.warning(f"Couldn't write metrics to {self.path}: {e}")
+            time.sleep(self.interval)
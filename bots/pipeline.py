@@ -0,0 +1,123 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# A bounded pool of workers for bot events, shared by all bots.
+#
+# Each piece of work comes with keys -- for bots, the nodes it will write to. Work on different keys runs
+# concurrently; work sharing a key runs one at a time, in the order it was submitted, so appends to a node file stay
+# in order. Work without keys runs whenever a worker is free. submit() blocks when too much work is waiting, which
+# pushes back on whatever is reading events (e.g. the streaming connection) instead of queueing without bound.
+
+import collections
+import logging
+import threading
+import time
+
+L = logging.getLogger('pipeline')
+
+WORKERS = 8
+MAX_QUEUED = 256
+
+class Task(object):
+
+    def __init__(self, keys, func, args):
+        self.keys = keys
+        self.func = func
+        self.args = args
+        # how many of our keys have older work still waiting or running.
+        self.blocked = 0
+        self.submitted = time.time()
+
+class Pipeline(object):
+
+    def __init__(self, workers=WORKERS, max_queued=MAX_QUEUED, metrics=None, name='pipeline'):
+        self.max_queued = max_queued
+        self.metrics = metrics
+        self.cond = threading.Condition()
+        # key -> tasks holding it, oldest (the one allowed to run) first.
+        self.heads = {}
+        self.ready = collections.deque()
+        # submitted and not finished yet, running or not.
+        self.pending = 0
+        self.busy = 0
+        for i in range(workers):
+            threading.Thread(target=self.run, daemon=True, name=f'{name}-{i}').start()
+
+    def submit(self, keys, func, *args):
+        """Queues func(*args) to run after all earlier work sharing any of keys. Blocks if the queue is full."""
+        task = Task(set(keys), func, args)
+        with self.cond:
+            if self.pending >= self.max_queued:
+                self.incr('backpressure')
+                L.info(f'{self.pending} events pending, waiting for workers.')
+                while self.pending >= self.max_queued:
+                    self.cond.wait()
+            self.pending += 1
+            for key in task.keys:
+                tasks = self.heads.setdefault(key, collections.deque())
+                if tasks:
+                    task.blocked += 1
+                tasks.append(task)
+            if not task.blocked:
+                self.ready.append(task)
+                self.cond.notify_all()
+            self.gauges()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                task = self.ready.popleft()
+                self.busy += 1
+                self.gauges()
+            self.incr('queue_wait', time.time() - task.submitted)
+            try:
+                task.func(*task.args)
+            except Exception:
+                L.exception(f'Error handling {task.func.__name__}.')
+                self.incr('errors')
+            with self.cond:
+                self.done(task)
+                self.gauges()
+                self.cond.notify_all()
+
+    def done(self, task):
+        for key in task.keys:
+            tasks = self.heads[key]
+            tasks.popleft()
+            if not tasks:
+                del self.heads[key]
+                continue
+            following = tasks[0]
+            following.blocked -= 1
+            if not following.blocked:
+                self.ready.append(following)
+        self.pending -= 1
+        self.busy -= 1
+
+    def wait(self):
+        """Blocks until all submitted work is done."""
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+
+    def incr(self, name, n=1):
+        if self.metrics:
+            self.metrics.incr(name, n)
+
+    def gauges(self):
+        if self.metrics:
+            self.metrics.set('queued', self.pending - self.busy)
+            self.metrics.set('busy', self.busy)
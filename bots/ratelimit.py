@@ -0,0 +1,242 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Rate limiting for API clients, shared by all bots.
+#
+# Each group of API calls (an endpoint, or a whole API if the service budgets it that way) gets a token bucket that
+# starts from a known budget (e.g. 300 calls per 5 minutes) and is corrected by the rate limit headers the service
+# sends back: we spread whatever the server says is left evenly until its reset time, and stop entirely when it says
+# nothing is. Calls wait for a token rather than fail, and a 429 that slips through makes the call wait for the reset
+# and retry. Wrap an API client in RateLimited to have all its methods go through a RateLimiter.
+
+import datetime
+import email.utils
+import functools
+import logging
+import threading
+import time
+
+L = logging.getLogger('ratelimit')
+
+# (calls, period in seconds) for buckets we know nothing about.
+DEFAULT_BUDGET = (60, 60)
+# how long to wait after a 429 that came without any hint of when to try again.
+PENALTY = 60
+# how many times to retry a call that got a 429.
+RETRIES = 3
+
+REMAINING_HEADERS = ['x-ratelimit-remaining', 'ratelimit-remaining', 'x-rate-limit-remaining']
+RESET_HEADERS = ['x-ratelimit-reset', 'ratelimit-reset', 'x-rate-limit-reset']
+
+class TokenBucket(object):
+
+    def __init__(self, calls, period):
+        self.default_rate = calls / period
+        self.rate = self.default_rate
+        # allow short bursts of up to a tenth of the budget.
+        self.capacity = max(1, calls // 10)
+        self.tokens = self.capacity
+        self.refilled = time.time()
+        # until when the rate set by the server applies; after that we go back to the default.
+        self.window_end = 0
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        if self.window_end and now >= self.window_end:
+            self.rate = self.default_rate
+            self.window_end = 0
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def reserve(self):
+        """Takes a token, returns how long to wait (in seconds) before using it."""
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def sync(self, remaining, reset):
+        """Applies what the server says: remaining calls allowed until reset (a timestamp)."""
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if reset and reset > now:
+                # spread what's left over the rest of the window.
+                self.rate = max(remaining, 1) / (reset - now)
+                self.window_end = reset
+                if remaining <= 0:
+                    self.blocked_until = reset
+
+    def block(self, until):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, until)
+
+class RateLimiter(object):
+
+    def __init__(self, budgets=None, default=DEFAULT_BUDGET, metrics=None):
+        """budgets maps bucket names to (calls, period in seconds)."""
+        self.budgets = budgets or {}
+        self.default = default
+        self.metrics = metrics
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = TokenBucket(*self.budgets.get(name, self.default))
+            return self.buckets[name]
+
+    def wait(self, name):
+        wait = self.bucket(name).reserve()
+        if wait > 0:
+            L.debug(f'Waiting {wait:.1f}s for a {name} token.')
+            self.incr('ratelimit_waits')
+            self.incr('ratelimit_wait_seconds', wait)
+            time.sleep(wait)
+
+    def update(self, name, headers):
+        """Corrects the bucket for name with the rate limit headers in a response, if there are any."""
+        headers = {key.lower(): value for key, value in headers.items()}
+        remaining = first(headers, REMAINING_HEADERS)
+        reset = parse_reset(first(headers, RESET_HEADERS))
+        if remaining is not None:
+            try:
+                self.bucket(name).sync(int(remaining), reset)
+            except ValueError:
+                pass
+        retry_after = parse_reset(headers.get('retry-after'))
+        if retry_after:
+            self.bucket(name).block(retry_after)
+
+    def call(self, name, limited, func, *args, **kwargs):
+        """Calls func once a token for name is available, waiting out and retrying rate limit errors.
+
+        limited(exception) tells rate limit errors apart from others.
+        """
+        for attempt in range(RETRIES + 1):
+            self.wait(name)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                headers = headers_of(e)
+                if headers:
+                    self.update(name, headers)
+                if not limited(e) or attempt == RETRIES:
+                    raise
+                self.incr('throttled')
+                if not headers:
+                    self.bucket(name).block(time.time() + PENALTY)
+                L.warning(f'Rate limited on {name}, waiting to retry.')
+                continue
+            headers = headers_of(result)
+            if headers:
+                self.update(name, headers)
+            return result
+
+    def incr(self, name, n=1):
+        if self.metrics:
+            self.metrics.incr(name, n)
+
+class RateLimited(object):
+    """Wraps an API client so that calling any of its methods goes through a RateLimiter.
+
+    bucket: None to give each method its own bucket, a name to share one bucket between all of them, or a function
+      from method name to bucket name.
+    limited: a function telling whether an exception means we were rate limited; by default, HTTP 429.
+    after: a function called with the client after each call, returning (remaining, reset) or None; for clients that
+      keep rate limit headers to themselves.
+    namespaces: names of attributes that hold more methods rather than being methods, e.g. app for atproto's
+      client.app.bsky.feed.post.list(). Everything under them is wrapped too, and bucket gets the dotted name of the
+      method (app.bsky.feed.post.list).
+    """
+
+    def __init__(self, api, limiter, bucket=None, limited=None, after=None, namespaces=(), prefix=''):
+        self.api = api
+        self.limiter = limiter
+        if bucket is None:
+            self.bucket = lambda name: name
+        elif callable(bucket):
+            self.bucket = bucket
+        else:
+            self.bucket = lambda name: bucket
+        self.limited = limited or (lambda e: status_of(e) == 429)
+        self.after = after
+        # None: everything that isn't a method is a namespace, as we're in one.
+        self.namespaces = namespaces
+        self.prefix = prefix
+        self.root = api
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            if (self.namespaces is None and not name.startswith('_')) or name in (self.namespaces or ()):
+                namespace = RateLimited(attr, self.limiter, self.bucket, self.limited, self.after, namespaces=None,
+                        prefix=self.prefix + name + '.')
+                namespace.root = self.root
+                return namespace
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            bucket = self.bucket(self.prefix + name)
+            result = self.limiter.call(bucket, self.limited, attr, *args, **kwargs)
+            if self.after:
+                budget = self.after(self.root)
+                if budget:
+                    self.limiter.bucket(bucket).sync(*budget)
+            return result
+        return call
+
+def first(headers, names):
+    for name in names:
+        if name in headers:
+            return headers[name]
+    return None
+
+def parse_reset(value):
+    """Reset headers come as a timestamp, seconds from now or an ISO date depending on the service."""
+    if value is None:
+        return None
+    try:
+        number = float(value)
+        # anything this big is a timestamp.
+        return number if number > 1e9 else time.time() + number
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        pass
+    # Retry-After can also be an HTTP date.
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def headers_of(obj):
+    """Finds response headers on a response, or on an exception carrying one."""
+    for candidate in (obj, getattr(obj, 'response', None)):
+        headers = getattr(candidate, 'headers', None)
+        if headers is not None and hasattr(headers, 'items'):
+            return headers
+    return None
+
+def status_of(e):
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None) or getattr(e, 'status_code', None)
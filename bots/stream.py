@@ -0,0 +1,212 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Buffered writes to the [[stream]], shared by all bots.
+#
+# Bots used to open, append to and close a node file for every post they saw; push.sh then ran git add . over the
+# whole stream every minute. Now they call StreamWriter.append() instead, which keeps appends in memory and writes
+# them out in batches: each file touched gets opened once per flush however many posts went to it. After each flush
+# the writer leaves a manifest (a list of the paths it wrote, relative to the stream root) in MANIFEST_DIR, so push.sh
+# can git add just those.
+#
+# Whatever is still in memory is written out on exit, including when we're stopped with SIGTERM (e.g. by systemd),
+# which we turn into a normal exit so that happens.
+
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+L = logging.getLogger('stream')
+
+# how often to write buffered appends to disk, in seconds.
+INTERVAL = 5
+# write out early if this many bytes are waiting, to bound memory use in a burst.
+MAX_BUFFERED = 1024 * 1024
+# under the stream root; push.sh reads and removes these.
+MANIFEST_DIR = '.stream-manifest'
+
+class StreamWriter(object):
+
+    def __init__(self, root, interval=INTERVAL, max_buffered=MAX_BUFFERED):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.interval = interval
+        self.max_buffered = max_buffered
+        # relative path -> [text, ...], in order of arrival.
+        self.pending = {}
+        # relative path -> [function, ...] to call once the pending appends to it are on disk.
+        self.callbacks = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+        # only one flush at a time, so appends to a file land in order.
+        self.flushing = threading.Lock()
+        self.closed = False
+        # called with (relpath, text) on every append, e.g. by bots/membership.py.
+        self.observers = []
+        self.wakeup = threading.Event()
+        atexit.register(self.close)
+        exit_on_sigterm()
+        threading.Thread(target=self.run, daemon=True, name='stream').start()
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def append(self, relpath, text, done=None):
+        """Queues text to be appended to relpath (relative to the stream root).
+
+        done, if given, is called without arguments once text is on disk; not at all if writing it fails.
+        """
+        with self.lock:
+            self.pending.setdefault(relpath, []).append(text)
+            if done:
+                self.callbacks.setdefault(relpath, []).append(done)
+            self.buffered += len(text)
+            full = self.buffered >= self.max_buffered
+        for observer in self.observers:
+            observer(relpath, text)
+        if full or self.closed:
+            self.flush()
+
+    def read(self, relpath):
+        """Returns what relpath will contain once flushed, or None if it doesn't exist yet.
+
+        Dedup checks should use this rather than reading the file, as the latest appends may still be in memory.
+        """
+        with self.lock:
+            pending = ''.join(self.pending.get(relpath, []))
+        try:
+            with open(self.path(relpath), 'r') as f:
+                return f.read() + pending
+        except FileNotFoundError:
+            return pending or None
+
+    def flush(self):
+        with self.flushing:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                callbacks, self.callbacks = self.callbacks, {}
+                self.buffered = 0
+            if not pending:
+                return []
+            appends = sum(len(texts) for texts in pending.values())
+            written = []
+            finished = []
+            dirs = set()
+            for relpath, texts in list(pending.items()):
+                full = self.path(relpath)
+                parent = os.path.dirname(full)
+                try:
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent, exist_ok=True)
+                        dirs.add(os.path.dirname(parent))
+                    if not os.path.exists(full):
+                        dirs.add(parent)
+                    with open(full, 'a') as f:
+                        f.write(''.join(texts))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    written.append(relpath)
+                except OSError as e:
+                    L.error(f"Couldn't write {len(texts)} appends to {full}: {e}")
+                    callbacks.pop(relpath, None)
+                except BaseException:
+                    # interrupted (e.g. by SIGTERM while flushing from the main thread): put back what we haven't
+                    # written so close() can still write it. The file we were on may get some appends twice.
+                    self.requeue(pending, callbacks)
+                    run_callbacks(finished)
+                    raise
+                del pending[relpath]
+                finished.extend(callbacks.pop(relpath, []))
+            # new files need their directory entries synced too to survive a crash.
+            for d in dirs:
+                fsync_dir(d)
+            run_callbacks(finished)
+            if written:
+                self.write_manifest(written)
+            L.debug(f'Flushed {appends} appends to {len(written)} files.')
+            return written
+
+    def requeue(self, pending, callbacks):
+        with self.lock:
+            for relpath, texts in pending.items():
+                self.pending[relpath] = texts + self.pending.get(relpath, [])
+                self.buffered += sum(len(text) for text in texts)
+            for relpath, functions in callbacks.items():
+                self.callbacks[relpath] = functions + self.callbacks.get(relpath, [])
+
+    def write_manifest(self, written):
+        manifests = os.path.join(self.root, MANIFEST_DIR)
+        os.makedirs(manifests, exist_ok=True)
+        name = f'{time.time():.6f}-{os.getpid()}'
+        tmp = os.path.join(manifests, '.' + name)
+        # write and rename, so push.sh never sees a partial list.
+        try:
+            with open(tmp, 'w') as f:
+                f.write(''.join(relpath + '\n' for relpath in written))
+            os.replace(tmp, os.path.join(manifests, name))
+        except OSError as e:
+            # push.sh falls back to scanning everything now and then, so this isn't fatal.
+            L.warning(f"Couldn't write stream manifest: {e}")
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                L.exception("Couldn't flush stream.")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+
+def exit_on_sigterm():
+    """Makes SIGTERM raise SystemExit in the main thread, so atexit handlers (close() above) get to run.
+
+    Python already does the equivalent for SIGINT (KeyboardInterrupt). Leaves alone handlers someone else installed,
+    and does nothing outside the main thread (e.g. in maubot), where signal handlers can't be set.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) not in (signal.SIG_DFL, None):
+        return
+    def handler(signum, frame):
+        L.info('Got SIGTERM, exiting.')
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, handler)
+
+def run_callbacks(callbacks):
+    for done in callbacks:
+        try:
+            done()
+        except Exception:
+            L.exception('Error in a stream write callback.')
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -25,6 +25,7 @@ import argparse
 import base64
 import cachetools.func
 import datetime
+import functools
 import glob
 import io
 import json
@@ -35,6 +36,7 @@ import random
 import re
 import requests
 import subprocess
+import sys
 import time
 import tweepy
 import urllib
@@ -43,6 +45,13 @@ import yaml
 # from .. import common 
 # see comment in ../mastodon/common.py.
 
+# shared code for all bots lives in the parent directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import links
+import membership
+import ratelimit
+import stream
+
 # Bot logic globals.
 # Regexes are in order of precedence.
 OPT_IN_RE = re.compile(r'#(optin|agora|push)|\[\[(optin|agora|push)\]\]', re.IGNORECASE)
@@ -55,9 +64,21 @@ HASHTAG_RE = re.compile(r'#(\w+)', re.IGNORECASE)
 DEFAULT_RE = re.compile(r'.', re.IGNORECASE)
 # Unused for now.
 P_HELP = 0.1
-# Backoff after Twitter exceptions, of which we seem to get many.
+# How long to wait between runs. Rate limits are handled by bots/ratelimit.py.
 BACKOFF = 15
-BACKOFF_MAX = 600
+# Twitter API v2 budgets per endpoint, as (calls, seconds) for user auth; calls we don't list get ratelimit.DEFAULT_BUDGET.
+BUDGETS = {
+    'get_users_mentions': (180, 900),
+    'get_home_timeline': (180, 900),
+    'create_tweet': (200, 900),
+    'retweet': (50, 900),
+    'follow_user': (50, 900),
+    'unfollow_user': (50, 900),
+    'get_users_followers': (15, 900),
+    'get_users_following': (15, 900),
+    'get_user': (900, 900),
+    'get_tweet': (900, 900),
+}
 
 # argparse
 parser = argparse.ArgumentParser(description='Agora Bot for Twitter.')
@@ -72,6 +93,8 @@ parser.add_argument('--timeline', dest='timeline', action="store_true", help='Wh
 parser.add_argument('--follow', dest='follow', action="store_true", help='Whether to follow back (this burns Twitter API quota so it might be worth disabling at times).')
 parser.add_argument('--max-age', dest='max_age', type=int, default=600, help='Threshold in age (minutes) beyond which we will not reply to tweets.')
 parser.add_argument('--dry-run', dest='dry_run', action="store_true", help='Whether to refrain from posting or making changes.')
+parser.add_argument('--links', dest='links', default='links.db', help='The path to an sqlite index of links already logged to nodes, can be non-existent; we\'ll create it.')
+parser.add_argument('--rebuild-links', dest='rebuild_links', action="store_true", help='Whether to rebuild the links index from the Markdown in the stream on start.')
 args = parser.parse_args()
 
 # logging
@@ -82,6 +105,10 @@ if args.verbose:
 else:
     L.setLevel(logging.INFO)
 
+STREAM = stream.StreamWriter(args.output_dir)
+LIMITER = ratelimit.RateLimiter(BUDGETS)
+LINKS = links.LinkIndex(args.links)
+
 class AgoraBot():
 
     def __init__(self, config):
@@ -109,15 +136,23 @@ class AgoraBot():
         self.access_token_secret = config['access_token_secret']
         self.since_id = config['since_id']
 
+        if args.rebuild_links or LINKS.empty():
+            LINKS.rebuild(os.path.join(args.output_dir, self.bot_username + '@twitter.com'))
+        # who is mentioned in which node (optin, push...) of our stream.
+        self.members = membership.MembershipIndex(STREAM, self.bot_username + '@twitter.com')
+
         auth = tweepy.OAuthHandler(self.consumer_key, self.consumer_secret)
         auth.set_access_token(self.access_token, self.access_token_secret)
 
         # give this another try?
         # api = tweepy.API(auth, wait_on_rate_limit=True)
         # Twitter v1 API
-        self.api = tweepy.API(auth)
+        self.api = ratelimit.RateLimited(tweepy.API(auth), LIMITER,
+                limited=lambda e: isinstance(e, tweepy.errors.TooManyRequests))
         # Twitter v2 API
-        self.client = tweepy.Client(self.bearer_token, self.consumer_key, self.consumer_secret, self.access_token, self.access_token_secret)
+        self.client = ratelimit.RateLimited(
+                tweepy.Client(self.bearer_token, self.consumer_key, self.consumer_secret, self.access_token, self.access_token_secret),
+                LIMITER, limited=lambda e: isinstance(e, tweepy.errors.TooManyRequests))
 
     # Currently unused.
     def get_path(self, tweet, n=10):
@@ -352,18 +387,12 @@ class AgoraBot():
 
         username = self.get_username(tweet.author_id)
 
-        user_stream_dir = common.mkdir(os.path.join(args.output_dir, username + '@twitter.com'))
-        user_stream_filename = os.path.join(user_stream_dir, node + '.md')
+        user_stream_filename = os.path.join(username + '@twitter.com', node + '.md')
 
         if self.wants_writes(username):
             L.info(f"User {username} has opted in to writing, pushing (publishing) full tweet text to an Agora.")
-            try:
-                with open(user_stream_filename, 'a') as note:
-                    # TODO: add timedate like Matrix, either move to Tweepy 4 to get some sense back or pipe through the creation date.
-                    note.write(f"- [[{tweet.created_at}]] @[[{username}]] {self.tweet_to_url(tweet)}\n\n  - {tweet.text}\n\n")
-            except:
-                L.error("Couldn't log full tweet to note in user stream.")
-                return
+            # TODO: add timedate like Matrix, either move to Tweepy 4 to get some sense back or pipe through the creation date.
+            STREAM.append(user_stream_filename, f"- [[{tweet.created_at}]] @[[{username}]] {self.tweet_to_url(tweet)}\n\n  - {tweet.text}\n\n")
         else:
             L.info(f"User {username} has NOT opted in, skipping logging full tweet.")
 
@@ -379,25 +408,16 @@ class AgoraBot():
             node = os.path.split(node)[-1]
 
         # dedup logic. we use the agora bot's stream as log as that's data under the control of the Agora (we only store a link).
-        try:
-            agora_stream_dir = common.mkdir(os.path.join(args.output_dir, self.bot_username + '@twitter.com'))
-            agora_stream_filename = os.path.join(agora_stream_dir, node + '.md')
-
-            with open(agora_stream_filename, 'r') as note:
-                if self.tweet_to_url(tweet) in note.read():
-                    L.info("Tweet already logged to note, skipping logging.")
-                    return False
-        except FileNotFoundError:
-            pass
+        # see bots/links.py.
+        agora_stream_filename = os.path.join(self.bot_username + '@twitter.com', node + '.md')
+        if not LINKS.add(node, self.tweet_to_url(tweet)):
+            L.info("Tweet already logged to note, skipping logging.")
+            return False
 
         L.info("Tweet will be logged to note.")
-        # try to append the link to the tweet in the relevant node (in agora bot stream).
-        try:
-            with open(agora_stream_filename, 'a') as note:
-                note.write(f"- [[{tweet.created_at}]] @[[{username}]]: {self.tweet_to_url(tweet)}\n")
-        except: 
-            L.error("Couldn't log tweet to note in bot stream.")
-            return
+        # append the link to the tweet in the relevant node (in agora bot stream), buffered -- see bots/stream.py.
+        STREAM.append(agora_stream_filename, f"- [[{tweet.created_at}]] @[[{username}]]: {self.tweet_to_url(tweet)}\n",
+                done=functools.partial(LINKS.logged, node, self.tweet_to_url(tweet)))
 
         # maybe write full tweet text in the user's own directory/repository (checks for opt in)
         self.write_tweet(tweet, node)
@@ -411,20 +431,11 @@ class AgoraBot():
             # for now, dump only to the last path fragment -- this yields the right behaviour in e.g. [[go/cat-tournament]]
             node = os.path.split(node)[-1]
 
-        agora_stream_dir = common.mkdir(os.path.join(args.output_dir, self.bot_username + '@twitter.com'))
-        filename = os.path.join(agora_stream_dir, node + '.md')
-        L.info(f"Checking if {username} is mentioned in {node} meaning {filename}.")
-
-        try:
-            with open(filename, 'r') as note:
-                if f'[[{username}]]' in note.read():
-                    L.info(f"User {username} is mentioned in {node}.")
-                    return True
-                else:
-                    L.info(f"User {username} not mentioned in {node}.")
-                    return False
-        except FileNotFoundError:
-            return False
+        if self.members.is_mentioned_in(username, node):
+            L.info(f"User {username} is mentioned in {node}.")
+            return True
+        L.info(f"User {username} not mentioned in {node}.")
+        return False
 
     def yaml_dump_tweets(self, tweets):
         if tweets:
@@ -782,7 +793,6 @@ class AgoraBot():
 
     # TODO: probably refactor into process_mentions and process_timeline? unsure.
     def process_mentions(self):
-        global BACKOFF
         # from https://realpython.com/twitter-bot-python-tweepy/
         L.info("# Retrieving mentions")
         new_since_id = self.since_id
@@ -798,7 +808,6 @@ class AgoraBot():
         except Exception as e:
             # Twitter gives back 429 surprisingly often for this, no way I'm hitting the stated limits?
             L.exception(f'# Twitter gave up on us while processing mentions, {e}.')
-            BACKOFF = min(BACKOFF * 2, BACKOFF_MAX)
             mentions = []
 
         # our tweets and those from users that follow us (actually that we follow, but we try to keep that up to date).
@@ -808,7 +817,6 @@ class AgoraBot():
             except Exception as e:
                 # Twitter gives back 429 surprisingly often for this, no way I'm hitting the stated limits?
                 L.exception(f'# Twitter gave up on us while trying to read the timeline, {e}.')
-                BACKOFF = min(BACKOFF * 2, BACKOFF_MAX)
                 timeline = []
         else:
             timeline = []
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# imports a [[fedwiki]] site into a directory of markdown files, one per page.
+# this does what fedwiki/main.go does (see CreateRecord there), but in process and incrementally: pages whose
+# journal didn't move since we last wrote them are left alone.
+#
+# usage: ./fedwiki.py http://vera.wiki.anagora.org /path/to/garden/vera.wiki.anagora.org
+
+import io
+import json
+import logging
+import os
+import sys
+import urllib.request
+
+L = logging.getLogger('fedwiki')
+
+# how much of the export to read at a time, in characters.
+CHUNK_SIZE = 64 * 1024
+# for http requests, in seconds.
+TIMEOUT = 60
+
+def iter_pages(stream):
+    """Yields (slug, page) from a fedwiki export.json, one page at a time.
+
+    The export is one big object keyed by slug; we decode it entry by entry so we never hold more than a page (and a
+    chunk) in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        # skips whitespace and any of chars, returns the next character (or '' at the end).
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill()
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # most likely the value continues in the next chunk.
+                if eof:
+                    raise
+                fill()
+                continue
+            # a number at the very end of the buffer might continue in the next chunk too.
+            if end == len(buf) and not eof:
+                fill()
+                continue
+            pos = end
+            return value
+
+    if skip('') != '{':
+        raise ValueError("export doesn't look like a fedwiki export (expected an object).")
+    pos += 1
+    while True:
+        c = skip(',')
+        if c == '}':
+            return
+        if c != '"':
+            raise ValueError(f'unexpected {c!r} in fedwiki export.')
+        slug = decode()
+        if skip('') != ':':
+            raise ValueError(f'expected : after {slug} in fedwiki export.')
+        pos += 1
+        skip('')
+        yield slug, decode()
+
+def page_content(page):
+    texts = [item['text'] for item in page.get('story') or [] if isinstance(item, dict) and 'text' in item]
+    return '\n\n'.join(text_string(text) for text in texts)
+
+def text_string(value):
+    """Like gjson's String() in main.go: null is empty, strings are as they are, anything else is its JSON."""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+def page_updated(page):
+    """Returns the latest journal date of a page, in milliseconds since the epoch."""
+    dates = [action.get('date') for action in page.get('journal') or [] if isinstance(action, dict)]
+    return max([int(date) for date in dates if isinstance(date, (int, float))], default=0)
+
+def write_page(slug, page, path):
+    """Writes a page unless the file on disk is already at the page's latest journal date.
+
+    Like CreateRecord in main.go, the file's mtime is set to that date. Returns 'added', 'modified' or None if we
+    didn't need to write.
+    """
+    filename = os.path.join(path, slug + '.md')
+    updated = page_updated(page) * 1000000
+    try:
+        if os.stat(filename).st_mtime_ns == updated:
+            return None
+        op = 'modified'
+    except FileNotFoundError:
+        op = 'added'
+
+    with open(filename, 'w') as f:
+        f.write(page_content(page))
+    os.utime(filename, ns=(updated, updated))
+    return op
+
+def sync_site(url, path):
+    """Imports the fedwiki site at url into path. Returns [(operation, file)] for the pages we wrote."""
+    os.makedirs(path, exist_ok=True)
+    changes = []
+    with urllib.request.urlopen(url.rstrip('/') + '/system/export.json', timeout=TIMEOUT) as response:
+        stream = io.TextIOWrapper(response, encoding='utf-8')
+        for slug, page in iter_pages(stream):
+            if '/' in slug or slug.startswith('.'):
+                L.warning(f'Skipping page with odd slug {slug} in {url}.')
+                continue
+            op = write_page(slug, page, path)
+            if op:
+                changes.append((op, slug + '.md'))
+    L.info(f'Imported {url} into {path}: {len(changes)} pages written.')
+    return changes
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sync_site(sys.argv[1], sys.argv[2])
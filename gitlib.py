@@ -0,0 +1,174 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# in-process git for pull.py (--backend dulwich): ls-remote, clone, fetch, fast-forward and reset using
+# [[dulwich]] instead of forking git for each of them.
+#
+# everything here blocks; pull.py runs it in threads. dulwich is optional: pip install dulwich.
+
+import io
+import os
+import stat
+
+from dulwich import porcelain
+from dulwich.client import get_transport_and_path
+from dulwich.index import index_entry_from_stat
+from dulwich.objects import S_ISGITLINK
+from dulwich.repo import Repo
+
+class GitError(Exception):
+    pass
+
+class NotFastForward(GitError):
+    pass
+
+def ls_remote(url, branch=None):
+    """Returns the sha the remote has for branch (or HEAD), or None if it has no such ref."""
+    client, path = get_transport_and_path(url)
+    refs = client.get_refs(path)
+    # newer versions of dulwich wrap the refs in an LsRemoteResult.
+    refs = getattr(refs, 'refs', refs)
+    sha = refs.get(f'refs/heads/{branch}'.encode('utf-8') if branch else b'HEAD')
+    return sha.decode('ascii') if sha else None
+
+def clone(url, path, depth=None):
+    # git clone creates missing parent directories, dulwich doesn't.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    porcelain.clone(url, path, depth=depth, checkout=True, errstream=io.BytesIO()).close()
+
+def fetch(path, depth=None):
+    """Fetches origin, updating refs/remotes/origin/*."""
+    with Repo(path) as repo:
+        porcelain.fetch(repo, 'origin', depth=depth, errstream=io.BytesIO())
+
+def current_branch(repo):
+    head = repo.refs.read_ref(b'HEAD')
+    if not head or not head.startswith(b'ref: refs/heads/'):
+        raise GitError(f'HEAD is detached in {repo.path}.')
+    return head[len(b'ref: '):]
+
+def is_ancestor(repo, old, new):
+    if old == new:
+        return True
+    for entry in repo.get_walker(include=[new]):
+        if entry.commit.id == old:
+            return True
+    return False
+
+def checkout(repo, old, new):
+    """Moves HEAD (and the branch it points to) from commit old to commit new, touching only files that changed.
+
+    Files that were modified locally but didn't change between old and new are left as they are.
+    """
+    old_tree = repo[old].tree if old else None
+    new_tree = repo[new].tree
+    index = repo.open_index()
+    root = repo.path
+    for change in repo.object_store.tree_changes(old_tree, new_tree):
+        (old_path, new_path), (_, mode), (_, sha) = change
+        if old_path and old_path != new_path:
+            try:
+                os.remove(os.path.join(root, os.fsdecode(old_path)))
+            except FileNotFoundError:
+                pass
+            try:
+                del index[old_path]
+            except KeyError:
+                pass
+        if not new_path or S_ISGITLINK(mode):
+            continue
+        write_file(repo, index, new_path, mode, sha)
+    index.write()
+    repo.refs[b'HEAD'] = new
+
+def hard_reset(repo, old, new):
+    """Like git reset --hard new: moves HEAD from old to new, and makes every tracked file match new.
+
+    Files are only rewritten if they changed between old and new, or if they look modified (their size or mtime
+    don't match the index, which is how git tells too). Untracked files stay, as with git.
+    """
+    if old != new:
+        checkout(repo, old, new)
+    index = repo.open_index()
+    root = repo.path
+    tracked = set()
+    for entry in repo.object_store.iter_tree_contents(repo[new].tree):
+        tracked.add(entry.path)
+        if S_ISGITLINK(entry.mode):
+            continue
+        try:
+            st = os.lstat(os.path.join(root, os.fsdecode(entry.path)))
+        except FileNotFoundError:
+            st = None
+        indexed = index[entry.path] if entry.path in index else None
+        if st is None or indexed is None or indexed.sha != entry.sha or not same_stat(indexed, st):
+            write_file(repo, index, entry.path, entry.mode, entry.sha)
+    # files added locally (git add), or left over from a checkout that didn't finish.
+    for path in list(index):
+        if path not in tracked:
+            try:
+                os.remove(os.path.join(root, os.fsdecode(path)))
+            except FileNotFoundError:
+                pass
+            del index[path]
+    index.write()
+
+def write_file(repo, index, path, mode, sha):
+    full = os.path.join(repo.path, os.fsdecode(path))
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    if os.path.lexists(full):
+        os.remove(full)
+    if stat.S_ISLNK(mode):
+        os.symlink(os.fsdecode(repo[sha].as_raw_string()), full)
+    else:
+        with open(full, 'wb') as f:
+            f.write(repo[sha].as_raw_string())
+        if mode & 0o111:
+            os.chmod(full, 0o755)
+    index[path] = index_entry_from_stat(os.lstat(full), sha, mode=mode)
+
+def same_stat(entry, st):
+    # index mtimes are (seconds, nanoseconds) or a plain number depending on the dulwich version.
+    if isinstance(entry.mtime, tuple):
+        mtime = entry.mtime[0] * 1000000000 + entry.mtime[1]
+    else:
+        mtime = int(entry.mtime * 1000000000)
+    return entry.size == st.st_size and mtime == st.st_mtime_ns
+
+def pull(path):
+    """Fetches origin and fast-forwards the current branch to it. Raises NotFastForward if it's not a fast-forward."""
+    fetch(path)
+    with Repo(path) as repo:
+        branch = current_branch(repo)
+        remote = repo.refs[b'refs/remotes/origin/' + branch[len(b'refs/heads/'):]]
+        local = repo.refs[b'HEAD']
+        if local == remote:
+            return
+        if not is_ancestor(repo, local, remote):
+            raise NotFastForward(f'{path}: {branch.decode()} and origin diverged.')
+        checkout(repo, local, remote)
+
+def reset(path, depth=None):
+    """Fetches origin and moves the current branch to it, whatever it was before, like git reset --hard origin/<branch>."""
+    fetch(path, depth=depth)
+    with Repo(path) as repo:
+        branch = current_branch(repo)
+        remote = repo.refs[b'refs/remotes/origin/' + branch[len(b'refs/heads/'):]]
+        hard_reset(repo, repo.refs[b'HEAD'], remote)
+
+def set_url(path, url):
+    with Repo(path) as repo:
+        config = repo.get_config()
+        config.set((b'remote', b'origin'), b'url', url.encode('utf-8'))
+        config.write_to_path()
@@ -16,17 +16,41 @@
 # an [[agora bridge]], that is, a utility that takes a .yaml file describing a set of [[personal knowledge graphs]] or [[digital gardens]] and pulls them to be consumed by other bridges or an [[agora server]]. [[flancian]]
 
 import argparse
+import asyncio
+import concurrent.futures
 import glob
+import hashlib
+import heapq
+import json
 import logging
 import os
+import random
+import re
+import shutil
+import signal
+import socket
+import tempfile
 import time
+import urllib.parse
 import yaml
-from multiprocessing import Pool, JoinableQueue, Process
 import subprocess
+import fedwiki
+from state import SyncState
+
+try:
+    # optional, see --backend.
+    import gitlib
+except ImportError:
+    gitlib = None
 this_path = os.getcwd()
 
 # for git commands, in seconds.
-TIMEOUT="60"
+TIMEOUT=60
+# for checking whether a garden that failed last time is reachable again, in seconds.
+PROBE_TIMEOUT=15
+# git lock files older than this (in seconds) were left behind by a git that died, unless some process is still
+# working in that repository.
+LOCK_MAX_AGE=2 * TIMEOUT
 
 def dir_path(string):
     if not os.path.isdir(string):
@@ -42,7 +66,22 @@ parser.add_argument('--output-dir', dest='output_dir', type=dir_path, required=T
 parser.add_argument('--verbose', dest='verbose', type=bool, default=False, help='Whether to log more information.')
 parser.add_argument('--reset', dest='reset', type=bool, default=False, help='Whether to git reset --hard whenever a pull fails.')
 parser.add_argument('--reset_only', dest='reset_only', type=bool, default=False, help='Whether do reset --hard instead of pulling.')
-parser.add_argument('--delay', dest='delay', type=float, default=0.1, help='Delay between pulls.')
+parser.add_argument('--delay', dest='delay', type=float, default=0.1, help='Delay between pulls to the same host.')
+parser.add_argument('--concurrency', dest='concurrency', type=int, default=256, help='Maximum number of syncs in flight overall.')
+parser.add_argument('--state', dest='state', default=os.path.join(this_path, 'state.db'), help='The path to a sqlite database where we keep sync state across restarts; it will be created if needed.')
+parser.add_argument('--changelog', dest='changelog', default=None, help='The path to an append-only log of changed files (one JSON record per line) for indexers to tail, e.g. changes.jsonl. Off by default.')
+parser.add_argument('--changelog-max-bytes', dest='changelog_max_bytes', type=int, default=64 * 1024 * 1024, help='Once --changelog grows past this many bytes it is moved to <changelog>.1 (replacing the previous one) and a new one is started.')
+parser.add_argument('--clone-mode', dest='clone_mode', choices=['full', 'shallow', 'blobless', 'treeless'], default='full', help='How to clone gardens that do not set clone_mode in the config: full history, shallow (latest commit only), blobless or treeless (partial clones).')
+parser.add_argument('--transport', dest='transport', choices=['default', 'multiplex'], default='default', help='With multiplex, keep one SSH connection per host open (ControlMaster) and reuse it across git commands, and ask for git protocol v2.')
+parser.add_argument('--backend', dest='backend', choices=['git', 'dulwich'], default='git', help='How to run git operations: by forking git, or in process with dulwich (pip install dulwich), which saves a process per operation. Partial clones (blobless, treeless) always use git.')
+parser.add_argument('--batch-window', dest='batch_window', type=float, default=30, help='When gardens on a host are due, also sync the ones on that host that are due within this many seconds, in the same batch.')
+parser.add_argument('--host-concurrency', dest='host_concurrency', action='append', default=[], help='Maximum number of syncs in flight per host, e.g. 8. Can be given as host=N to override the limit for one host, e.g. github.com=32. Can be repeated.')
+parser.add_argument('--urgent-concurrency', dest='urgent_concurrency', type=int, default=16, help='Maximum number of requested syncs (see /sources/<target>/pull in the api) in flight, on top of --concurrency.')
+parser.add_argument('--webhook-interval', dest='webhook_interval', type=float, default=6 * 3600, help='Time between syncs of gardens whose forge sends us push webhooks (see /webhook in the api), in seconds. These are polled only as a fallback.')
+parser.add_argument('--quarantine-after', dest='quarantine_after', type=int, default=10, help='Consecutive failed syncs after which a garden is quarantined, i.e. only retried every --quarantine-interval.')
+parser.add_argument('--quarantine-interval', dest='quarantine_interval', type=float, default=24 * 3600, help='Time between retries of quarantined gardens, in seconds.')
+parser.add_argument('--min-interval', dest='min_interval', type=float, default=60, help='Minimum time between syncs of a garden, in seconds. Gardens that changed recently are polled this often.')
+parser.add_argument('--max-interval', dest='max_interval', type=float, default=3600, help='Maximum time between syncs of a garden, in seconds. Gardens that keep coming back unchanged back off exponentially up to this.')
 args = parser.parse_args()
 
 logging.basicConfig()
@@ -52,110 +91,894 @@ if args.verbose:
 else:
     L.setLevel(logging.INFO)
 
-Q = JoinableQueue()
-WORKERS = 6
+# default for --host-concurrency.
+HOST_CONCURRENCY = 8
+# extra git clone arguments per clone_mode, which can be set per source in the config (or with --clone-mode).
+CLONE_MODES = {
+        'full': [],
+        'shallow': ['--depth', '1'],
+        'blobless': ['--filter=blob:none'],
+        'treeless': ['--filter=tree:0'],
+        }
+# how long to keep shared SSH connections around after their last use with --transport multiplex, in seconds.
+CONTROL_PERSIST = 300
+# extra environment and options for git, see setup_transport().
+GIT_ENV = None
+# keep everything we fetch as packs, so we can tell how much we fetched by looking at new pack files (except when
+# auto gc repacks, see sync()).
+GIT_OPTIONS = ['-c', 'fetch.unpackLimit=1']
+# see state.py, set up in main().
+STATE = None
+# see ChangeLog, set up in main().
+CHANGELOG = None
+# how often to check --config for changes, in seconds.
+CONFIG_INTERVAL = 5
+# gardens count as sending webhooks for this long after the last one, in seconds; after that we assume the webhook
+# is gone and poll them like the rest.
+WEBHOOK_EXPIRY = 7 * 24 * 3600
+# runs gitlib operations with --backend dulwich, see setup_backend().
+EXECUTOR = None
+# repositories a gitlib thread is working on, which can outlive a sync that timed out; see run_gitlib().
+GITLIB_BUSY = set()
+# see PullMetrics, set up in main().
+METRICS = None
+# how often to write live metrics to the state database, in seconds.
+METRICS_INTERVAL = 5
+# upper bounds for the sync duration histogram, in seconds.
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# git diff --name-status letters to changelog operations.
+OPERATIONS = {'A': 'added', 'M': 'modified', 'D': 'deleted', 'T': 'modified'}
+# scp-like git urls, e.g. git@github.com:flancian/garden.git.
+SCP_RE = re.compile(r'^(?:[^@/]+@)?([^:/]+):')
 
-def git_clone(url, path):
+class Scheduler(object):
+    """Keeps track of when each source is next due for a sync.
 
-    if os.path.exists(path):
-        L.info(f"{path} exists, won't clone to it.")
-        return 42
+    Sources that come back unchanged get polled exponentially less often, up to max_interval; sources that changed
+    go back to being polled every min_interval. Sources being synced are not in the heap until the worker reports back.
+    Sources someone asked for (see request()) skip the line. Sources with webhooks get told about changes, so they
+    are only polled every webhook_interval; source['webhook'] is when we last got one. If polling one of those finds a
+    change anyway, the webhook missed it and we go back to polling it like the rest until the next one.
+
+    Sources that fail are retried exponentially less often; after quarantine_after failures in a row they are
+    quarantined and only retried every quarantine_interval, so dead or moved repos don't take slots from live ones.
+    """
+
+    def __init__(self, min_interval, max_interval, webhook_interval, quarantine_after, quarantine_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.webhook_interval = webhook_interval
+        self.quarantine_after = quarantine_after
+        self.quarantine_interval = quarantine_interval
+        # target -> consecutive failed syncs.
+        self.failures = {}
+        self.sources = {}
+        self.intervals = {}
+        self.heap = []
+        # targets being synced right now.
+        self.running = set()
+        # targets someone asked us to sync now, oldest request first.
+        self.urgent = []
+        # targets being synced because someone asked.
+        self.requested = set()
+
+    def add(self, source, due=None, interval=None, failures=0):
+        target = source['target']
+        self.sources[target] = source
+        self.intervals[target] = interval or self.intervals.get(target, self.min_interval)
+        if failures:
+            self.failures[target] = failures
+        if target not in self.running:
+            heapq.heappush(self.heap, (due or time.time(), target))
+
+    def remove(self, target):
+        """Stops scheduling target. A sync already running for it finishes, but isn't scheduled again."""
+        self.sources.pop(target, None)
+        self.intervals.pop(target, None)
+        self.failures.pop(target, None)
+        self.unschedule(target)
+
+    def quarantined(self, target):
+        return self.failures.get(target, 0) >= self.quarantine_after
+
+    def unschedule(self, target):
+        heap = [(due, t) for due, t in self.heap if t != target]
+        if len(heap) < len(self.heap):
+            heapq.heapify(heap)
+            self.heap = heap
+
+    def request(self, target):
+        """Asks for target to be synced as soon as possible. Requests for a target that is already waiting count as one."""
+        if target not in self.sources:
+            L.warning(f"Got a request to sync {target}, which is not in the config.")
+        elif target not in self.urgent:
+            self.urgent.append(target)
+
+    def due_urgent(self):
+        """Pops and returns the sources that were asked for, see request()."""
+        sources = []
+        for target in list(self.urgent):
+            if target in self.running:
+                # the sync running now might have looked before whatever prompted the request; go again after it.
+                continue
+            self.urgent.remove(target)
+            if target not in self.sources:
+                continue
+            self.unschedule(target)
+            self.running.add(target)
+            self.requested.add(target)
+            sources.append(self.sources[target])
+        return sources
+
+    def has_webhook(self, target):
+        last = self.sources[target].get('webhook')
+        return bool(last) and time.time() - last < WEBHOOK_EXPIRY
+
+    def due(self, window=0):
+        """Pops and returns all sources that are due now.
+
+        If window is set, sources on the same hosts that would be due within window seconds are popped as well, so
+        they can be synced in the same batch.
+        """
+        now = time.time()
+        sources = []
+        while self.heap and self.heap[0][0] <= now:
+            _, target = heapq.heappop(self.heap)
+            sources.append(self.sources[target])
+
+        if window and sources:
+            hosts = {source['host'] for source in sources}
+            rest = []
+            for due, target in self.heap:
+                if due <= now + window and self.sources[target]['host'] in hosts:
+                    sources.append(self.sources[target])
+                else:
+                    rest.append((due, target))
+            if len(rest) < len(self.heap):
+                heapq.heapify(rest)
+                self.heap = rest
+
+        self.running.update(source['target'] for source in sources)
+        return sources
+
+    def wait(self):
+        """Returns how long until the next source is due, in seconds."""
+        if not self.heap:
+            return self.max_interval
+        return max(0, self.heap[0][0] - time.time())
+
+    def done(self, target, changed, error=None):
+        # changed is None when we can't tell, in which case we keep the current interval.
+        self.running.discard(target)
+        requested = target in self.requested
+        self.requested.discard(target)
+        if target not in self.sources:
+            # removed while we were syncing it.
+            return None, None
+        interval = self.intervals[target]
+        if error:
+            failures = self.failures[target] = self.failures.get(target, 0) + 1
+            if failures == self.quarantine_after:
+                L.warning(f"{target} failed {failures} times in a row, quarantining it: {error}")
+            if failures >= self.quarantine_after:
+                interval = self.quarantine_interval
+            else:
+                interval = min(self.min_interval * 2 ** failures, self.max_interval)
+        elif self.failures.pop(target, 0):
+            # back from the dead, most likely with a change or a fixed url; look again soon.
+            L.info(f"{target} synced again after failing.")
+            interval = self.min_interval
+        elif self.has_webhook(target) and (requested or not changed):
+            interval = self.webhook_interval
+        elif changed:
+            if self.sources[target].get('webhook'):
+                L.info(f"{target} changed without a webhook telling us, polling it normally until the next one.")
+                self.sources[target]['webhook'] = None
+            interval = self.min_interval
+        elif changed is not None:
+            interval = min(interval * 2, self.max_interval)
+        self.intervals[target] = interval
+        # a bit of jitter so gardens added at the same time don't stay in lockstep forever.
+        due = time.time() + interval * random.uniform(0.9, 1.1)
+        L.debug(f"{target}: changed: {changed}, next sync in {interval:.0f}s.")
+        heapq.heappush(self.heap, (due, target))
+        return interval, due
+
+class SyncError(Exception):
+    pass
+
+class Histogram(object):
+    """A prometheus style histogram: counts[i] is how many observations were <= buckets[i]."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+
+    def dump(self):
+        return {'buckets': list(zip(self.buckets, self.counts)), 'sum': self.sum, 'count': self.count}
+
+class PullMetrics(object):
+    """What pull.py is doing right now, dumped to the state database for the api's /metrics and /status."""
+
+    def __init__(self):
+        self.started = time.time()
+        # target -> what the sync holding a slot for it is doing.
+        self.active = {}
+        self.durations = Histogram(BUCKETS)
+        self.counters = {'syncs': 0, 'changed': 0, 'failed': 0, 'bytes': 0, 'requested': 0, 'locks_removed': 0}
+
+    def observe(self, duration, changed, error, fetched):
+        self.durations.observe(duration)
+        self.counters['syncs'] += 1
+        self.counters['changed'] += bool(changed)
+        self.counters['failed'] += bool(error)
+        self.counters['bytes'] += fetched
+
+    def dump(self, scheduler):
+        return {
+                'started': self.started,
+                'updated': time.time(),
+                'gardens': len(scheduler.sources),
+                # popped from the schedule, but waiting for a host or global slot.
+                'waiting': len(scheduler.running) - len(self.active),
+                'requested': len(scheduler.urgent),
+                'active': [dict(target=target, **activity) for target, activity in self.active.items()],
+                'counters': self.counters,
+                'durations': self.durations.dump(),
+                }
+
+class SourcesWatcher(object):
+    """Notices when the sources config changes, so we can pick up new gardens without restarting."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.digest = None
+
+    def check(self):
+        """Returns the parsed config if it changed since the last check (or on the first check), None otherwise."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            L.warning(f"Couldn't stat {self.path}: {e}")
+            return None
+        if (st.st_mtime_ns, st.st_size) == self.stat:
+            return None
+        self.stat = (st.st_mtime_ns, st.st_size)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # editors and the api rewrite the file without necessarily changing it.
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.digest:
+            return None
+        try:
+            config = yaml.safe_load(data) or []
+        except yaml.YAMLError as e:
+            # keep going with what we had; we'll try again when the file changes.
+            L.error(f"Couldn't parse {self.path}: {e}")
+            return None
+        if not isinstance(config, list):
+            L.error(f"{self.path} should be a list of sources, not {type(config).__name__}; ignoring it.")
+            return None
+        self.digest = digest
+        return valid_sources(config)
+
+def valid_sources(config):
+    """Returns the sources in config that we can sync, logging and skipping the rest."""
+    sources = []
+    targets = set()
+    for i, item in enumerate(config):
+        if not isinstance(item, dict):
+            L.error(f"Skipping source #{i} in the config: not a mapping.")
+            continue
+        target = item.get('target')
+        problem = None
+        if not isinstance(target, str) or not target.strip():
+            problem = 'no target'
+        elif os.path.isabs(target) or '..' in target.split('/'):
+            problem = 'target must be a path under --output-dir'
+        elif target in targets:
+            problem = 'duplicate target'
+        else:
+            for key in ('url', 'format'):
+                if not isinstance(item.get(key), str) or not item[key].strip():
+                    problem = f'no {key}'
+                    break
+        if problem:
+            L.error(f"Skipping source #{i} ({target}) in the config: {problem}.")
+            continue
+        targets.add(target)
+        sources.append(item)
+    return sources
+
+class ChangeLog(object):
+    """An append-only log of the files each sync changed, one JSON record per line.
+
+    Indexers can tail this instead of rescanning or diffing every garden. Each record has the user (the garden's
+    directory), the path of the file within the garden, the old and new sha and the operation (added, modified or
+    deleted). If we can't tell which files changed, we write a single record with operation rescan and no path.
+
+    Past max_bytes the log is rotated to path.1, like logrotate would; readers should follow the name (tail -F).
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = open(path, 'a')
+
+    def write(self, target, old, new, changes):
+        now = time.time()
+        user = os.path.basename(target)
+        lines = [json.dumps({'time': now, 'user': user, 'target': target, 'path': path, 'old': old, 'new': new, 'op': op}) + '\n'
+                for op, path in changes]
+        # one write per sync, so readers never see half a batch of lines.
+        self.file.write(''.join(lines))
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        try:
+            os.replace(self.path, self.path + '.1')
+        except OSError as e:
+            L.error(f"Couldn't rotate {self.path}: {e}")
+        self.file = open(self.path, 'a')
+
+class HostLimits(object):
+    """Caps the number of syncs in flight per host, so each forge gets its own budget."""
+
+    def __init__(self, specs):
+        self.default = HOST_CONCURRENCY
+        self.limits = {}
+        for spec in specs:
+            if '=' in spec:
+                host, n = spec.rsplit('=', 1)
+                self.limits[host] = int(n)
+            else:
+                self.default = int(spec)
+        self.semaphores = {}
+
+    def get(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limits.get(host, self.default))
+        return self.semaphores[host]
+
+def url_host(url):
+    """Returns the host a git url points to, or 'localhost' for local paths."""
+    if '://' in url:
+        return urllib.parse.urlsplit(url).hostname or 'localhost'
+    match = SCP_RE.match(url)
+    if match and not os.path.exists(url):
+        return match.group(1)
+    return 'localhost'
+
+async def run_gitlib(func, *args, path=None, timeout=TIMEOUT):
+    """Runs one of the gitlib functions in a thread (see --backend), raising SyncError if it fails.
+
+    path is the repository func works on, if any: we don't start on a repository another thread is still busy with.
+    """
+    if path in GITLIB_BUSY:
+        raise SyncError(f'{func.__name__}: an earlier operation on {path} is still running.')
+
+    def work():
+        try:
+            return func(*args)
+        finally:
+            GITLIB_BUSY.discard(path)
+
+    if path:
+        GITLIB_BUSY.add(path)
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(EXECUTOR, work), timeout)
+    except asyncio.TimeoutError:
+        # the thread carries on until its socket times out too, see setup_backend().
+        raise SyncError(f'{func.__name__} timed out after {timeout}s.')
+    except Exception as e:
+        raise SyncError(f'{func.__name__}: {e!r}')
+
+async def run_git(*args, cwd=None, timeout=TIMEOUT):
+    """Runs git with a timeout, without blocking the event loop. Returns (returncode, stdout, stderr)."""
+    # in its own process group, so a timeout can take down what git started too (git fetch, ssh, remote helpers).
+    proc = await asyncio.create_subprocess_exec(
+            'git', *GIT_OPTIONS, *args, cwd=cwd, env=GIT_ENV, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        L.warning(f"git {args[0]} in {cwd} timed out after {timeout}s.")
+        if cwd:
+            # we just killed it, so whatever it had locked is fair game.
+            recover_locks(cwd, max_age=0)
+        # same exit code as timeout(1), which we used to call out to.
+        return 124, b'', b'timed out'
+    return proc.returncode, stdout, stderr
+
+def repo_busy(path):
+    """Returns whether any process is working in the repository at path, going by their cwd in /proc (Linux only).
+
+    Also whether one of our gitlib threads is, which /proc can't tell us (see run_gitlib()).
+    """
+    path = os.path.realpath(path)
+    if any(os.path.realpath(busy) == path for busy in list(GITLIB_BUSY)):
+        return True
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except FileNotFoundError:
+        return False
+    for pid in pids:
+        try:
+            cwd = os.readlink(f'/proc/{pid}/cwd')
+        except OSError:
+            # gone already, or not ours to look at.
+            continue
+        if cwd == path or cwd.startswith(path + os.sep):
+            return True
+    return False
+
+def recover_locks(path, max_age=LOCK_MAX_AGE):
+    """Removes lock files a killed or crashed git left behind in the repository at path, so it can be synced again."""
+    git_dir = os.path.join(path, '.git')
+    locks = glob.glob(os.path.join(glob.escape(git_dir), '*.lock'))
+    locks += glob.glob(os.path.join(glob.escape(git_dir), 'refs', '**', '*.lock'), recursive=True)
+    now = time.time()
+    stale = []
+    for lock in locks:
+        try:
+            if now - os.stat(lock).st_mtime >= max_age:
+                stale.append(lock)
+        except FileNotFoundError:
+            pass
+    # gc.pid is git's lock for gc; it only counts while the pid in it is alive.
+    try:
+        with open(os.path.join(git_dir, 'gc.pid')) as f:
+            pid, host = f.read().split(maxsplit=1)
+        if host.strip() == socket.gethostname() and not os.path.exists(f'/proc/{int(pid)}'):
+            stale.append(os.path.join(git_dir, 'gc.pid'))
+    except (OSError, ValueError):
+        pass
+    if not stale:
+        return
+    if repo_busy(path):
+        L.info(f"{path} has old lock files, but something is still working in it: {stale}")
+        return
+    for lock in stale:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            continue
+        L.warning(f"Removed stale lock {lock}.")
+        METRICS.counters['locks_removed'] += 1
 
-    L.info(f"Running git clone {url} to path {path}")
+def git_head(path):
+    """Returns (branch, sha) for HEAD in path.
 
+    This reads .git directly instead of forking git, as we do it for every garden every cycle.
+    """
+    git_dir = os.path.join(path, '.git')
     try:
-        output = subprocess.run(['timeout', TIMEOUT, 'git', 'clone', url, path], capture_output=True)
-    except subprocess.TimeoutExpired as e:
-        # should not happen since we now call out to 'timeout' command.
-        L.warning(f"Couldn't clone repo {url}, skipping.")
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None, None
 
-    L.info(output)
-    if output.stderr:
-        L.error(f'Error while cloning {url}: {output.stderr}')
+    if not head.startswith('ref: '):
+        # detached HEAD.
+        return None, head
 
-def git_reset(path):
-    L.info(f'Trying to git reset --hard')
-    subprocess.run(['timeout', TIMEOUT, 'git', 'fetch', 'origin'])
-    branch = subprocess.run(['git', 'symbolic-ref', '--short', 'HEAD'], capture_output=True).stdout.strip()
-    branch = branch.decode("utf-8")
-    output = subprocess.run(['timeout', TIMEOUT, 'git', 'reset', '--hard', f'origin/{branch}'], capture_output=True)
-    L.info(f'output: {output.stdout}')
-    if output.stderr:
-        L.error(output.stderr)
+    ref = head[len('ref: '):]
+    branch = ref[len('refs/heads/'):]
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            return branch, f.read().strip()
+    except FileNotFoundError:
+        pass
 
+    # the ref might be packed (e.g. right after a clone).
+    try:
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return branch, line.split(' ')[0]
+    except FileNotFoundError:
+        pass
+    return branch, None
 
-def git_pull(path):
+async def git_ls_remote(url, branch=None, timeout=TIMEOUT):
+    """Returns the sha the remote has for branch (or HEAD), or None if we couldn't tell."""
+    if EXECUTOR:
+        try:
+            return await run_gitlib(gitlib.ls_remote, url, branch, timeout=timeout)
+        except SyncError as e:
+            L.warning(f'Error while running ls-remote for {url}: {e}')
+            return None
+    ref = f'refs/heads/{branch}' if branch else 'HEAD'
+    returncode, stdout, stderr = await run_git('ls-remote', url, ref, timeout=timeout)
+    if returncode != 0:
+        L.warning(f'Error while running ls-remote for {url}: {stderr}')
+        return None
+    for line in stdout.decode('utf-8').splitlines():
+        sha, name = line.split('\t', 1)
+        if name == ref:
+            return sha
+    return None
+
+async def git_changes(path, old, new):
+    """Returns [(operation, file)] for the files that changed between old and new, or None if we can't tell.
+
+    If old is None (a fresh clone), every file in new counts as added.
+    """
+    if old:
+        returncode, stdout, stderr = await run_git('diff', '--name-status', '--no-renames', '-z', old, new, cwd=path)
+        if returncode != 0:
+            # e.g. a shallow garden no longer has the old commit.
+            L.warning(f"Couldn't diff {old}..{new} in {path}: {stderr}")
+            return None
+        fields = stdout.decode('utf-8', 'replace').split('\0')
+        return [(OPERATIONS.get(op[:1], 'modified'), name) for op, name in zip(fields[0::2], fields[1::2]) if name]
+
+    returncode, stdout, stderr = await run_git('ls-tree', '-r', '-z', '--name-only', new, cwd=path)
+    if returncode != 0:
+        L.warning(f"Couldn't list files of {new} in {path}: {stderr}")
+        return None
+    return [('added', name) for name in stdout.decode('utf-8', 'replace').split('\0') if name]
+
+def pack_sizes(path):
+    """Returns {pack file name: size} for the packs in the repository in path."""
+    try:
+        with os.scandir(os.path.join(path, '.git', 'objects', 'pack')) as entries:
+            return {e.name: e.stat().st_size for e in entries if e.name.endswith('.pack')}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+def garden_size(source):
+    """Returns roughly how much space a garden takes, in bytes: its packs, or its pages for fedwiki."""
+    if source['format'] != 'fedwiki':
+        return sum(pack_sizes(source['path']).values())
+    try:
+        with os.scandir(source['path']) as entries:
+            return sum(e.stat().st_size for e in entries if e.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+
+async def git_clone(url, path, clone_mode='full'):
+
+    if os.path.exists(path):
+        L.info(f"{path} exists, won't clone to it.")
+        return 42
+
+    L.info(f"Running git clone {url} to path {path} ({clone_mode})")
+    if EXECUTOR and clone_mode in ('full', 'shallow'):
+        try:
+            await run_gitlib(gitlib.clone, url, path, 1 if clone_mode == 'shallow' else None, path=path)
+        except SyncError as e:
+            L.error(f'Error while cloning {url}: {e}')
+            raise
+        return
+    returncode, stdout, stderr = await run_git('clone', *CLONE_MODES[clone_mode], url, path)
+    if returncode != 0:
+        L.error(f'Error while cloning {url}: {stderr}')
+        # git cleans up after itself when a clone fails, but not when we kill it. A half clone would look like a
+        # garden that just fails to pull from then on. It didn't exist before (see above), so it's ours to remove.
+        shutil.rmtree(path, ignore_errors=True)
+        raise SyncError(stderr.decode('utf-8', 'replace').strip())
+
+async def git_reset(path, depth=None, clone_mode='full'):
+    L.info(f'Trying to git reset --hard in {path}')
+    if EXECUTOR and clone_mode in ('full', 'shallow'):
+        await run_gitlib(gitlib.reset, path, depth, path=path)
+        return
+    if depth:
+        returncode, stdout, stderr = await run_git('fetch', '--depth', str(depth), 'origin', cwd=path)
+    else:
+        returncode, stdout, stderr = await run_git('fetch', 'origin', cwd=path)
+    if returncode != 0:
+        L.error(f'{path}: {stderr}')
+        raise SyncError(stderr.decode('utf-8', 'replace').strip())
+    branch, _ = git_head(path)
+    returncode, stdout, stderr = await run_git('reset', '--hard', f'origin/{branch}', cwd=path)
+    L.info(f'output: {stdout}')
+    if returncode != 0:
+        L.error(stderr)
+        raise SyncError(stderr.decode('utf-8', 'replace').strip())
+
+async def git_pull(path, clone_mode='full'):
 
     if not os.path.exists(path):
         L.warning(f"{path} doesn't exist, couldn't pull to it.")
         return 42
 
-    try:
-        os.chdir(path)
-    except FileNotFoundError:
-        L.error(f"Couldn't pull in {path} due to the directory being missing, clone must be run first")
+    if clone_mode == 'shallow':
+        # pulling would deepen (and try to merge into) a shallow clone, so we just move to the latest commit instead.
+        await git_reset(path, depth=1, clone_mode=clone_mode)
+        return
 
     if args.reset_only:
-        git_reset(path)
+        await git_reset(path, clone_mode=clone_mode)
         return
 
     # Is there a value to trying pull first? Could we just reset --hard?
     L.info(f"Running git pull in path {path}")
+    if EXECUTOR and clone_mode == 'full':
+        try:
+            # fast-forward only; gardens are not supposed to have local commits.
+            await run_gitlib(gitlib.pull, path, path=path)
+        except SyncError as e:
+            L.error(f'{path}: {e}')
+            if not args.reset:
+                raise
+            await git_reset(path, clone_mode=clone_mode)
+        return
+    returncode, stdout, stderr = await run_git('pull', cwd=path)
+    L.info(stdout)
+    if returncode != 0:
+        L.error(f'{path}: {stderr}')
+        if not args.reset:
+            raise SyncError(stderr.decode('utf-8', 'replace').strip())
+        await git_reset(path, clone_mode=clone_mode)
+
+async def git_set_url(path, url):
+    L.info(f'Pointing {path} to {url}.')
+    if EXECUTOR:
+        await run_gitlib(gitlib.set_url, path, url, path=path)
+        return
+    returncode, stdout, stderr = await run_git('remote', 'set-url', 'origin', url, cwd=path)
+    if returncode != 0:
+        L.error(f'{path}: {stderr}')
+        raise SyncError(stderr.decode('utf-8', 'replace').strip())
+
+async def git_sync(url, path, clone_mode='full', failing=False):
+    """Clones or pulls a garden, but only pulls if the remote moved.
+
+    Returns whether anything changed, raises SyncError if we couldn't sync. If the garden failed to sync last time
+    (failing), we only go on to pull once we know the remote is reachable.
+    """
+    if not os.path.exists(path):
+        await git_clone(url, path, clone_mode)
+        return True
+
+    branch, local = git_head(path)
+    remote = await git_ls_remote(url, branch, timeout=PROBE_TIMEOUT if failing else TIMEOUT)
+    if remote and remote == local:
+        L.debug(f"{path} is up to date at {local}, skipping pull.")
+        return False
+    if not remote and failing:
+        # don't spend a fetch (and with --reset, another fetch and a reset) on finding out it's still broken.
+        raise SyncError(f"{url} is still unreachable, or has no branch {branch}.")
+
+    # if we couldn't tell, fall back to pulling as we used to.
+    await git_pull(path, clone_mode)
+    return git_head(path)[1] != local
+
+async def fedwiki_import(url, path):
+    """Imports a fedwiki site, see fedwiki.py. Returns [(operation, file)] for the pages that changed."""
+    loop = asyncio.get_running_loop()
     try:
-        # output = subprocess.run(['git', 'pull'], capture_output=True, timeout=10)
-        output = subprocess.run(['timeout', TIMEOUT, 'git', 'pull'], capture_output=True)
-    except subprocess.TimeoutExpired as e:
-        # should not happen since we now call out to 'timeout' command.
-        L.warning(f"Error while pulling repo in path {path}, skipping.")
-
-    L.info(output.stdout)
-    if output.stderr:
-        L.error(f'{path}: {output.stderr}')
-        if args.reset:
-            git_reset(path)
-
-def fedwiki_import(url, path):
-    os.chdir(this_path)
-    output = subprocess.run([f"{this_path}/fedwiki.sh", url, path], capture_output=True)
-    L.info(output.stdout)
-
-def worker():
+        # fedwiki.py does blocking http and file io.
+        return await loop.run_in_executor(None, fedwiki.sync_site, url, path)
+    except (OSError, ValueError) as e:
+        L.error(f'Error while importing {url}: {e}')
+        raise SyncError(str(e))
+
+async def sync(scheduler, limit, host_limits, source):
+    host = source['host']
+    changed = None
+    error = None
+    # wait for the host first, so gardens queued up behind a busy forge do not hold global slots.
+    async with host_limits.get(host), limit:
+        L.debug(f"Syncing {source['target']} from {host}, {len(scheduler.running)} syncs in flight.")
+        started = time.time()
+        METRICS.active[source['target']] = {'host': host, 'started': started}
+        packs = pack_sizes(source['path'])
+        _, old = git_head(source['path'])
+        try:
+            if source['format'] == "fedwiki":
+                pages = await fedwiki_import(source['url'], source['path'])
+                changed = bool(pages)
+                if CHANGELOG and pages:
+                    CHANGELOG.write(source['target'], None, None, pages)
+            else:
+                recover_locks(source['path'])
+                if source.get('repoint') and os.path.exists(source['path']):
+                    await git_set_url(source['path'], source['url'])
+                source.pop('repoint', None)
+                changed = await git_sync(source['url'], source['path'], source['clone_mode'],
+                        failing=source['target'] in scheduler.failures)
+        except SyncError as e:
+            error = str(e) or 'unknown error'
+        except Exception as e:
+            L.exception(f"Error while syncing {source['target']}.")
+            error = repr(e)
+        if error:
+            # back off as if nothing had changed.
+            changed = False
+        duration = time.time() - started
+        after = pack_sizes(source['path'])
+        if set(packs) - set(after):
+            # git's auto gc put the packs together (we get one per fetch, see GIT_OPTIONS), so the new pack is the
+            # whole repository rather than what we fetched; better to count nothing for this one.
+            fetched = 0
+        else:
+            fetched = sum(size for name, size in after.items() if name not in packs)
+        _, new = git_head(source['path'])
+        if CHANGELOG and new and new != old:
+            changes = await git_changes(source['path'], old, new)
+            CHANGELOG.write(source['target'], old, new, changes if changes is not None else [('rescan', None)])
+        METRICS.active.pop(source['target'], None)
+        METRICS.observe(duration, changed, error, fetched)
+        # be nice to the host before giving up our slot.
+        await asyncio.sleep(args.delay)
+    # tell the scheduler so it can decide when to run this again.
+    interval, due = scheduler.done(source['target'], changed, error)
+    STATE.record(source['target'], source['url'], started, duration, sha=new, changed=changed, error=error,
+            bytes=fetched, size=garden_size(source), interval=interval, next_due=due,
+            quarantined=scheduler.quarantined(source['target']))
+
+async def sync_batch(scheduler, limit, host_limits, batch):
+    """Syncs a batch of gardens that live on the same host."""
+    if GIT_ENV and len(batch) > 1:
+        # let the first sync open the shared connection before the rest pile onto it.
+        await sync(scheduler, limit, host_limits, batch[0])
+        batch = batch[1:]
+    await asyncio.gather(*[sync(scheduler, limit, host_limits, source) for source in batch])
+
+def setup_backend():
+    """Sets up in-process git operations if asked for, see --backend."""
+    global EXECUTOR
+    if args.backend != 'dulwich':
+        return
+    if not gitlib:
+        L.error("--backend dulwich needs dulwich (pip install dulwich), falling back to forking git.")
+        return
+    # these are blocking calls, one thread per sync we might have in flight.
+    EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency + args.urgent_concurrency)
+    # we can't kill a thread like we kill git on timeouts, but we can make sure its network calls time out.
+    socket.setdefaulttimeout(TIMEOUT)
+    L.info("Running git operations in process with dulwich.")
+
+def setup_transport():
+    """Sets up git so that commands going to the same host share a connection, see --transport."""
+    global GIT_ENV, GIT_OPTIONS
+    if args.transport != 'multiplex':
+        return
+
+    # unix sockets have short path limits, so keep this short (%C is a hash of the connection parameters).
+    control_dir = tempfile.mkdtemp(prefix='agora-ssh-')
+    GIT_ENV = dict(os.environ)
+    GIT_ENV.setdefault('GIT_SSH_COMMAND',
+            f'ssh -o ControlMaster=auto -o ControlPath={control_dir}/%C -o ControlPersist={CONTROL_PERSIST}')
+    # v2 lets ls-remote and fetch ask only for the refs they need instead of getting every ref advertised.
+    # each git process still makes its own HTTPS connection, batching is what helps there.
+    GIT_OPTIONS = GIT_OPTIONS + ['-c', 'protocol.version=2']
+    L.info(f"Sharing SSH connections per host through {control_dir}.")
+
+def prepare_source(item):
+    item['path'] = os.path.join(args.output_dir, item['target'])
+    item['host'] = url_host(item['url'])
+    item.setdefault('clone_mode', args.clone_mode)
+    if item['clone_mode'] not in CLONE_MODES:
+        L.warning(f"Unknown clone_mode {item['clone_mode']} for {item['target']}, falling back to {args.clone_mode}.")
+        item['clone_mode'] = args.clone_mode
+
+def schedule_source(scheduler, item):
+    # gardens we synced before pick up their schedule where we left off, so restarts don't pull everything at once.
+    # the rest are due right away; git_sync clones them if this is a new garden (or agora).
+    garden = STATE.get(item['target'])
+    if garden and garden['last_webhook']:
+        item['webhook'] = garden['last_webhook']
+    if garden and garden['next_due'] and os.path.exists(item['path']):
+        scheduler.add(item, due=garden['next_due'], interval=garden['interval'], failures=garden['consecutive_errors'])
+    else:
+        scheduler.add(item)
+
+def reload_sources(scheduler, config):
+    """Brings the schedule in line with a new version of the sources config.
+
+    Syncs already running carry on with the source as it was; changes apply from the next sync on.
+    """
+    sources = {item['target']: item for item in config}
+    for target in list(scheduler.sources):
+        if target not in sources:
+            # we leave the clone alone, it's not ours to delete.
+            L.info(f"{target} is gone from the config, not syncing it anymore.")
+            scheduler.remove(target)
+    for target, item in sources.items():
+        prepare_source(item)
+        old = scheduler.sources.get(target)
+        if not old:
+            L.info(f"New garden {target} in the config, scheduling it.")
+            schedule_source(scheduler, item)
+            continue
+        if old.get('webhook') and item['url'] == old['url']:
+            item['webhook'] = old['webhook']
+        if old.get('repoint') or item['url'] != old['url']:
+            # the clone is still pointing to the old url, see sync().
+            item['repoint'] = True
+        if item != old:
+            L.info(f"{target} changed in the config, using {item['url']} from the next sync on.")
+            scheduler.sources[target] = item
+
+async def run(scheduler, watcher):
+    limit = asyncio.Semaphore(args.concurrency)
+    host_limits = HostLimits(args.host_concurrency)
+    # requested syncs get their own slots, so they don't queue up behind the regular ones.
+    urgent_limit = asyncio.Semaphore(args.urgent_concurrency)
+    urgent_host_limits = HostLimits(args.host_concurrency)
+    # asyncio only keeps weak references to tasks.
+    tasks = set()
+    L.info(f"Running up to {args.concurrency} syncs at a time, {host_limits.default} per host by default.")
+    dumped = 0
+    checked = time.time()
     while True:
-        L.debug("Queue size: {}".format(Q.qsize()))
-        task = Q.get(block=True, timeout=60)
-        task[0](*task[1:])
-        Q.task_done()
-        # if this is a pull, schedule the same task for another run later.
-        if task[0] == git_pull or task[0] == fedwiki_import:
-            Q.put(task)
-        time.sleep(args.delay)
+        if time.time() - dumped > METRICS_INTERVAL:
+            STATE.put_metrics('pull', METRICS.dump(scheduler))
+            dumped = time.time()
+        if time.time() - checked > CONFIG_INTERVAL:
+            config = watcher.check()
+            if config is not None:
+                L.info(f"{watcher.path} changed, reloading sources.")
+                reload_sources(scheduler, config)
+            checked = time.time()
+
+        for target, requested, origin in STATE.take_requests():
+            L.info(f"{origin} asked for {target} to be synced.")
+            METRICS.counters['requested'] += 1
+            if origin.startswith('webhook') and target in scheduler.sources:
+                scheduler.sources[target]['webhook'] = requested
+            scheduler.request(target)
+        for source in scheduler.due_urgent():
+            task = asyncio.create_task(sync(scheduler, urgent_limit, urgent_host_limits, source))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        batches = {}
+        for source in scheduler.due(args.batch_window):
+            batches.setdefault(source['host'], []).append(source)
+        for host, batch in batches.items():
+            task = asyncio.create_task(sync_batch(scheduler, limit, host_limits, batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.sleep(min(scheduler.wait(), 1))
 
 def main():
+    global STATE, CHANGELOG, METRICS
 
-    try:
-        config = yaml.safe_load(args.config)
-    except yaml.YAMLError as e:
-        L.error(e)
+    # --config is read through the watcher, so we notice when it changes later on.
+    args.config.close()
+    watcher = SourcesWatcher(args.config.name)
+    config = watcher.check()
+    if config is None:
+        L.error(f"Couldn't load sources from {args.config.name}.")
+        return
 
+    STATE = SyncState(args.state)
+    METRICS = PullMetrics()
+    if args.changelog:
+        CHANGELOG = ChangeLog(args.changelog, args.changelog_max_bytes)
+    scheduler = Scheduler(args.min_interval, args.max_interval, args.webhook_interval,
+            args.quarantine_after, args.quarantine_interval)
     for item in config:
-        path = os.path.join(args.output_dir, item['target'])
-        if item['format'] == "fedwiki":
-            Q.put((fedwiki_import, item['url'], path))
-            continue
-        # schedule one 'clone' run for every garden, in case this is a new garden (or agora).
-        Q.put((git_clone, item['url'], path))
-        # pull it once, it will be queued again later from the worker.
-        Q.put((git_pull, path))
-
-    processes = []
-    for i in range(WORKERS):
-        worker_process = Process(target=worker, daemon=True, name='worker_process_{}'.format(i))
-        processes.append(worker_process)
-
-    L.info(f"Starting {WORKERS} workers to execute work items.")
-    for process in processes:
-        process.start()
-    Q.join()
+        prepare_source(item)
+        schedule_source(scheduler, item)
+
+    setup_backend()
+    setup_transport()
+    asyncio.run(run(scheduler, watcher))
 
 if __name__ == "__main__":
     main()
@@ -11,10 +11,27 @@
 # If this broke you: sorry :)
 cd ~/agora/stream
 
+# the bots write in batches and list what they wrote in here (see bots/stream.py), so we only add those files
+# instead of scanning the whole stream every time.
+MANIFESTS=.stream-manifest
+# ...but still add everything now and then, in case something was written some other way.
+FULL_EVERY=60
+
+grep -qxF "/${MANIFESTS}/" .git/info/exclude 2>/dev/null || echo "/${MANIFESTS}/" >> .git/info/exclude
+
 # YOLO :)
+n=0
 while true; do 
-	git add .
-	git commit -a -m "stream update"
+	# manifests starting with . are still being written. listed before adding anything, so we only remove the ones
+	# whose files we did add.
+	manifests=$(ls ${MANIFESTS}/[0-9]* 2>/dev/null)
+	if [ $((n % FULL_EVERY)) -eq 0 ]; then
+		git add -A . && [ -n "${manifests}" ] && rm -f ${manifests}
+	elif [ -n "${manifests}" ]; then
+		cat ${manifests} | sort -u | xargs -r -d '\n' git add -- && rm -f ${manifests}
+	fi
+	git diff --cached --quiet || git commit -m "stream update"
 	git push
+	n=$((n + 1))
 	sleep 60
 done
@@ -0,0 +1,156 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# sync state for [[agora bridge]]: what we know about each garden, kept in sqlite so it survives restarts.
+# pull.py writes it, the api reads it.
+
+import json
+import sqlite3
+import time
+
+# a garden that should have been synced this long ago (in seconds) but wasn't is considered stale.
+STALE_AFTER = 600
+
+SCHEMA = """
+create table if not exists gardens (
+    target text primary key,
+    url text,
+    -- when we last tried to sync, and when that last worked.
+    last_fetch real,
+    last_success real,
+    last_change real,
+    -- HEAD after the last successful sync.
+    sha text,
+    duration real,
+    errors integer not null default 0,
+    consecutive_errors integer not null default 0,
+    last_error text,
+    -- bytes fetched, total.
+    bytes integer not null default 0,
+    -- space taken on disk after the last sync, in bytes.
+    size integer,
+    -- since when we only retry this garden rarely, as it kept failing (see --quarantine-after in pull.py).
+    quarantined real,
+    -- when a forge last told us about a push; gardens with webhooks need much less polling.
+    last_webhook real,
+    -- scheduling state, so a restart picks up where we left off.
+    interval real,
+    next_due real
+);
+
+-- gardens someone asked pull.py to sync right away; one row per garden, so repeated requests count as one.
+create table if not exists requests (
+    target text primary key,
+    requested real,
+    origin text
+);
+
+-- live metrics snapshots (JSON), e.g. what pull.py is doing right now.
+create table if not exists metrics (
+    name text primary key,
+    updated real,
+    value text
+);
+"""
+
+# columns added to gardens after it was first created, and their types.
+COLUMNS = {'size': 'integer', 'last_webhook': 'real', 'quarantined': 'real'}
+
+class SyncState(object):
+
+    def __init__(self, path):
+        self.path = path
+        # the api reads this while pull.py writes it, WAL lets them do that concurrently.
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.executescript(SCHEMA)
+        # databases created before a column was added.
+        columns = [row['name'] for row in self.db.execute('pragma table_info(gardens)')]
+        for column, kind in COLUMNS.items():
+            if column not in columns:
+                self.db.execute(f'alter table gardens add column {column} {kind}')
+
+    def close(self):
+        self.db.close()
+
+    def get(self, target):
+        row = self.db.execute('select * from gardens where target = ?', (target,)).fetchone()
+        return dict(row) if row else None
+
+    def all(self):
+        return [dict(row) for row in self.db.execute('select * from gardens order by target')]
+
+    def record(self, target, url, started, duration, sha=None, changed=None, error=None, bytes=0, size=None, interval=None, next_due=None, quarantined=False):
+        """Records the outcome of one sync."""
+        with self.db:
+            self.db.execute('insert or ignore into gardens (target) values (?)', (target,))
+            if error:
+                self.db.execute("""
+                    update gardens set url = ?, last_fetch = ?, duration = ?, errors = errors + 1,
+                    consecutive_errors = consecutive_errors + 1, last_error = ?, size = coalesce(?, size),
+                    interval = ?, next_due = ?, quarantined = case when ? then coalesce(quarantined, ?) end
+                    where target = ?""",
+                    (url, started, duration, error, size, interval, next_due, bool(quarantined), started, target))
+            else:
+                self.db.execute("""
+                    update gardens set url = ?, last_fetch = ?, last_success = ?, duration = ?, sha = coalesce(?, sha),
+                    last_change = case when ? then ? else last_change end, consecutive_errors = 0, bytes = bytes + ?,
+                    size = coalesce(?, size), interval = ?, next_due = ?, quarantined = null
+                    where target = ?""",
+                    (url, started, started, duration, sha, bool(changed), started, bytes, size, interval, next_due, target))
+
+    def request(self, target, origin='api'):
+        """Asks pull.py to sync target as soon as it can. Returns False if a request for it was already pending."""
+        with self.db:
+            cursor = self.db.execute('insert or ignore into requests (target, requested, origin) values (?, ?, ?)',
+                    (target, time.time(), origin))
+        return cursor.rowcount > 0
+
+    def record_webhook(self, target):
+        with self.db:
+            self.db.execute('insert or ignore into gardens (target) values (?)', (target,))
+            self.db.execute('update gardens set last_webhook = ? where target = ?', (time.time(), target))
+
+    def take_requests(self):
+        """Returns and forgets pending requests, as [(target, requested, origin)], oldest first."""
+        rows = [tuple(row) for row in self.db.execute('select target, requested, origin from requests order by requested')]
+        if rows:
+            # a request for one of these coming in now is covered by the sync we're about to do; others stay put.
+            with self.db:
+                self.db.executemany('delete from requests where target = ?', [(row[0],) for row in rows])
+        return rows
+
+    def put_metrics(self, name, value):
+        with self.db:
+            self.db.execute('insert or replace into metrics (name, updated, value) values (?, ?, ?)',
+                    (name, time.time(), json.dumps(value)))
+
+    def get_metrics(self, name):
+        row = self.db.execute('select value from metrics where name = ?', (name,)).fetchone()
+        return json.loads(row['value']) if row else None
+
+def health(garden, now=None):
+    """Returns 'quarantined', 'failing', 'stale', 'healthy' or 'unknown' for a row as returned by SyncState."""
+    now = now or time.time()
+    if not garden or not garden.get('last_fetch'):
+        return 'unknown'
+    if garden.get('quarantined'):
+        return 'quarantined'
+    if garden['consecutive_errors']:
+        return 'failing'
+    if garden['next_due'] and now - garden['next_due'] > STALE_AFTER:
+        return 'stale'
+    return 'healthy'